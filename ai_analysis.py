@@ -16,6 +16,8 @@ from tqdm import tqdm
 from dotenv import load_dotenv
 import openai
 
+from core import DATETIME_COLUMNS, shift_facts
+
 load_dotenv()
 
 openai.organization = os.getenv("OPENAI_ORG_ID", "")
@@ -440,20 +442,18 @@ def _load_data_tables(table_dir):
                             validation_report.append(f"Confirmed {multi_worker_shifts} shifts with multiple workers")
                             insights["data_quality"].append(f"Multiple workers can be assigned to the same shift ({multi_worker_shifts} examples found)")
                     
-                    # Perform shift-level aggregation for key metrics
-                    shift_agg = df.groupby('shift_id').agg({
-                        'claimed_at': lambda x: (~pd.isna(x)).any(),  # Shift was claimed by at least one worker
-                        'canceled_at': lambda x: (~pd.isna(x)).any(),  # Shift had at least one cancellation
-                        'is_verified': lambda x: x.any(),  # Shift was completed successfully
-                        'is_ncns': lambda x: x.any(),  # Shift had at least one no-show
-                        'rate': ['mean', 'min', 'max']  # Rate statistics for the shift
-                    })
+                    # Perform shift-level aggregation for key metrics; tables read back from CSV hold
+                    # their timestamps as strings, so parse them before lead times are derived
+                    for col in DATETIME_COLUMNS:
+                        if col in df.columns:
+                            df[col] = pd.to_datetime(df[col], format='ISO8601', errors='coerce')
+                    shift_agg = shift_facts(df)
                     
                     if not shift_agg.empty:
-                        # Calculate shift-level metrics
+                        # Calculate shift-level metrics (claimed / completed by at least one worker)
                         total_unique_shifts = len(shift_agg)
-                        filled_shifts = shift_agg[('claimed_at', '<lambda_0>')].sum()
-                        completed_shifts = shift_agg[('is_verified', '<lambda_0>')].sum()
+                        filled_shifts = (shift_agg['claims'] > 0).sum()
+                        completed_shifts = (shift_agg['completed'] > 0).sum()
                         
                         # Calculate fill rate based on unique shifts
                         fill_rate = filled_shifts / total_unique_shifts if total_unique_shifts > 0 else 0
@@ -465,7 +465,7 @@ def _load_data_tables(table_dir):
                         ])
                         
                         # Check for dynamic pricing by analyzing rate variation within shifts
-                        rate_variation = shift_agg[('rate', 'max')] - shift_agg[('rate', 'min')]
+                        rate_variation = shift_agg['max_rate'] - shift_agg['min_rate']
                         shifts_with_price_changes = (rate_variation > 0).sum()
                         
                         if shifts_with_price_changes > 0:
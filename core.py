@@ -14,6 +14,15 @@ from datetime import datetime, timedelta
 import warnings
 from pathlib import Path
 import yaml
+import json
+import shutil
+import hashlib
+import weakref
+import glob
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pandas.api.types import union_categoricals
+from scipy import sparse
 
 # Suppress warnings
 warnings.filterwarnings('ignore')
@@ -25,6 +34,114 @@ TABLE_DIR = OUTPUT_DIR / 'tables'
 TIME_ANALYSIS_DIR = PLOT_DIR / 'time_analysis'
 RETENTION_DIR = TABLE_DIR / 'retention'
 
+# Columnar cache of prepared offer data (see load_data)
+CACHE_DIR = Path('.cache') / 'offers'
+CACHE_VERSION = 6
+
+# Persisted store of appended offer partitions and their merged aggregates (see append_to_store)
+STORE_DIR = Path('.cache') / 'store'
+
+# Persisted segmentation models (scaler, centroids, segment names) reused across runs
+# (see segment_model); a model is refit once the mean squared distance of the current
+# population to its centroids exceeds the fit-time value by this factor. The model format
+# is versioned on its own: bump SEGMENT_MODEL_VERSION when the saved schema changes
+SEGMENT_MODEL_DIR = Path('.cache') / 'segments'
+SEGMENT_MODEL_VERSION = 1
+SEGMENT_DRIFT_TOLERANCE = 1.25
+
+# Data dictionary locations, in order of preference
+DATA_DICTIONARY_PATHS = ['data_dictionary.yml', Path('context') / 'data_dictionary.yml']
+
+# read_csv dtypes for each data dictionary type; datetimes are parsed separately
+SCHEMA_DTYPES = {
+    'string': 'category',
+    'float': 'float32',
+    'boolean': 'boolean',
+    'datetime': None
+}
+# Float fields that feed pay and earnings, read as float64 so money sums keep every cent
+MONEY_FIELDS = ['rate', 'charge_rate', 'duration']
+DATETIME_FORMAT = 'ISO8601'
+
+# Derived features computed on first access instead of on load: name -> (function, source columns).
+# Populated by @derived_feature below; read through feature(df, name).
+FEATURES = {}
+_FEATURE_MEMO = {}
+
+# Derived flags materialized on load because nearly every analysis reads them
+LOAD_FEATURES = ['claimed', 'canceled', 'deleted']
+
+# Shift value buckets (see shift_value_analysis)
+SHIFT_VALUE_BINS = [0, 100, 200, 300, 400, 500, 1000, 2000]
+SHIFT_VALUE_LABELS = ['$0-100', '$100-200', '$200-300', '$300-400', '$400-500', '$500-1000', '$1000+']
+
+# Entity keys replaced by dense int32 codes on load; the original IDs by code travel with the
+# frame in df.attrs['id_lookups'] (see encode_ids)
+ID_COLUMNS = ['worker_id', 'workplace_id', 'shift_id']
+
+# Timestamp columns of the offer table, parsed on load
+DATETIME_COLUMNS = ['shift_start_at', 'shift_created_at', 'offer_viewed_at', 'claimed_at', 'canceled_at', 'deleted_at']
+
+# Rows per chunk when streaming aggregates from a file too large to load (see stream_aggregates)
+AGGREGATE_CHUNKSIZE = 500_000
+
+# Bucket definitions shared by the in-memory and streaming analyses
+RATE_BUCKET_SIZE = 5  # $5 increments
+LEAD_TIME_BINS = [0, 1, 2, 3, 5, 7, 14, 30, 60]
+LEAD_TIME_LABELS = ['Same day', '1 day', '2 days', '3-4 days', '5-6 days', '1-2 weeks', '2-4 weeks', '1-2 months']
+MARGIN_BINS = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 1.0]
+MARGIN_LABELS = ['0-10%', '10-20%', '20-30%', '30-40%', '40-50%', '50%+']
+DECISION_TIME_BINS = [0, 1, 5, 15, 30, 60, 120, 240, 1440]  # minutes
+DECISION_TIME_LABELS = ['<1m', '1-5m', '5-15m', '15-30m', '30-60m', '1-2h', '2-4h', '4-24h']
+
+# Funnel stages after the view: count column -> offer flag it counts (see funnel)
+FUNNEL_STAGES = {'claims': 'claimed', 'completions': 'is_verified', 'cancellations': 'canceled', 'no_shows': 'is_ncns'}
+
+# Time index granularities: bucket width in nanoseconds (see time_index)
+TIME_INDEX_FREQS = {'day': 24 * 3600 * 10**9, 'hour': 3600 * 10**9}
+
+# Standard offer bucketings pre-aggregated by offer_cube
+CUBE_DIMENSIONS = ['slot', 'view_hour', 'view_day_of_week', 'rate_bucket', 'lead_time_bucket', 'margin_bucket']
+
+# Filled-shift counts at which workplace stickiness is measured: the full curve and its highlighted points
+WORKPLACE_RETENTION_CURVE = list(range(1, 51))
+WORKPLACE_RETENTION_THRESHOLDS = [1, 3, 5, 10, 15]
+
+# Cohort period granularities and their approximate length in days
+COHORT_PERIODS = {'day': 1, 'week': 7, 'month': 30}
+
+# Worker segmentation: candidate cluster counts, and the scalable mode (MiniBatchKMeans scored
+# by silhouette on a stratified sample) used from this many active workers upwards
+SEGMENTATION_K_RANGE = range(2, 7)
+SCALABLE_SEGMENTATION_MIN_WORKERS = 50_000
+SILHOUETTE_SAMPLE_SIZE = 10_000
+
+# Mergeable partial aggregates built per chunk: table -> (group keys, column reducers)
+_PARTIAL_AGGREGATES = {
+    'workers': (['worker_id'], {
+        'views': 'sum', 'claims': 'sum', 'completed': 'sum', 'cancellations': 'sum', 'no_shows': 'sum',
+        'rate_sum': 'sum', 'rate_count': 'sum', 'claimed_rate_sum': 'sum', 'claimed_rate_count': 'sum',
+        'earnings': 'sum'
+    }),
+    'workplaces': (['workplace_id'], {
+        'views': 'sum', 'claims': 'sum', 'completed': 'sum', 'cancellations': 'sum', 'deleted': 'sum',
+        'rate_sum': 'sum', 'rate_count': 'sum', 'charge_rate_sum': 'sum', 'charge_rate_count': 'sum',
+        'margin_sum': 'sum', 'margin_count': 'sum', 'lead_time_sum': 'sum', 'lead_time_count': 'sum',
+        'shift_created_at': 'max'
+    }),
+    'shifts': (['workplace_id', 'shift_id'], {'rate_sum': 'sum', 'rate_count': 'sum', 'deleted': 'sum'}),
+    'rate_buckets': (['rate_bucket'], {'views': 'sum', 'claims': 'sum', 'no_shows': 'sum'}),
+    'lead_time_shifts': (['lead_time_bucket', 'shift_id'], {'views': 'sum', 'claims': 'sum', 'completed': 'sum'}),
+    'margin_shifts': (['margin_bucket', 'shift_id'], {'views': 'sum'}),
+    'margin_buckets': (['margin_bucket'], {'views': 'sum', 'claims': 'sum', 'completed': 'sum'}),
+    'hours': (['view_hour'], {'views': 'sum', 'claims': 'sum'}),
+    'days': (['view_day_of_week'], {'views': 'sum', 'claims': 'sum', 'rate_sum': 'sum', 'rate_count': 'sum'}),
+    'marketplace': (['marketplace'], {
+        'rate_sum': 'sum', 'rate_count': 'sum', 'lead_time_sum': 'sum', 'lead_time_count': 'sum',
+        'margin_count': 'sum', 'shift_created_at': 'max'
+    })
+}
+
 # Create directories if they don't exist
 for directory in [OUTPUT_DIR, PLOT_DIR, TABLE_DIR, TIME_ANALYSIS_DIR, RETENTION_DIR]:
     directory.mkdir(exist_ok=True, parents=True)
@@ -56,88 +173,1366 @@ COLORS = {
 }
 
 
-def load_data(file_path='data.csv'):
-    """Load and prepare the dataset."""
+def load_data(file_path='data.csv', use_cache=True, columns=None, start=None, end=None, 
+              date_column='offer_viewed_at', workers=None):
+    """Load and prepare the dataset from a CSV, directory of partitions or glob, cached per source fingerprint."""
     print(f"Loading data from {file_path}...")
+
+    # Load data dictionary if available
+    data_dict = _load_data_dictionary()
     
-    # Load data
-    df = pd.read_csv(file_path)
-    
-    # Normalize column names to lowercase
-    df.columns = df.columns.str.lower()
-    print(f"Columns available: {', '.join(df.columns)}")
+    partitions = _resolve_partitions(file_path)
+    is_subset = columns is not None or start is not None or end is not None
+    read_columns = None
+    if columns is not None:
+        read_columns = list(columns) + ([date_column] if start is not None or end is not None else [])
+
+    # Serve the prepared frame from the columnar cache when the source is unchanged
+    cache_path = None
+    if use_cache:
+        cache_path = CACHE_DIR / f"{_cache_stem(file_path)}-{_file_fingerprint(partitions, data_dict)}"
+        if (cache_path / 'manifest.json').exists():
+            try:
+                df = _read_cache(cache_path, read_columns)
+            except Exception as e:
+                print(f"Error reading cache {cache_path}, re-parsing source: {e}")
+            else:
+                df = _select_offers(df, columns, start, end, date_column)
+                print(f"Loaded {len(df)} records from cache {cache_path}")
+                return encode_ids(df), data_dict
     
-    # Convert datetime columns
-    datetime_cols = ['shift_start_at', 'shift_created_at', 'offer_viewed_at', 
-                     'claimed_at', 'canceled_at', 'deleted_at']
-    for col in datetime_cols:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col])
+    if len(partitions) == 1:
+        df = _read_offers(partitions[0], data_dict, read_columns, start, end, date_column)
+    else:
+        df = _read_partitions(partitions, data_dict, read_columns, start, end, date_column, workers)
     
-    # Load data dictionary if available
-    data_dict = None
-    if os.path.exists('data_dictionary.yml'):
-        with open('data_dictionary.yml', 'r') as f:
-            data_dict = yaml.safe_load(f)
+    if cache_path is not None and not is_subset:
+        try:
+            _write_cache(df, cache_path)
+            print(f"Cached prepared data to {cache_path}")
+        except Exception as e:
+            print(f"Error writing cache {cache_path}: {e}")
     
-    # Basic data validation and cleaning
-    print(f"Loaded {len(df)} records")
+    return encode_ids(_select_offers(df, columns)), data_dict
+
+
+def _resolve_partitions(file_path):
+    """Expand a CSV path, directory of CSVs or glob pattern into a sorted list of files."""
+    file_path = str(file_path)
+    if os.path.isdir(file_path):
+        partitions = sorted(glob.glob(os.path.join(file_path, '*.csv')))
+    elif glob.has_magic(file_path):
+        partitions = sorted(glob.glob(file_path))
+    else:
+        return [file_path]
     
-    # Make sure we have rate column with correct name
-    if 'pay_rate' in df.columns and 'rate' not in df.columns:
-        df['rate'] = df['pay_rate']
+    if not partitions:
+        raise FileNotFoundError(f"No CSV partitions found at {file_path}")
+    return partitions
+
+
+def _cache_stem(file_path):
+    """Readable, filesystem-safe cache name for a file, directory or glob, unique to its full path."""
+    file_path = str(file_path).rstrip('/\\')
+    if os.path.isfile(file_path):
+        name = Path(file_path).stem
+    else:
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', file_path).strip('_') or 'offers'
+    source = hashlib.blake2b(os.path.abspath(file_path).encode(), digest_size=4).hexdigest()
+    return f"{name}-{source}"
+
+
+def _read_partitions(partitions, data_dict, columns=None, start=None, end=None, 
+                     date_column='offer_viewed_at', workers=None):
+    """Parse and prepare CSV partitions in a process pool and combine them in partition order."""
+    workers = min(workers or os.cpu_count() or 1, len(partitions))
+    print(f"Parsing {len(partitions)} partitions with {workers} processes...")
+    
+    n = len(partitions)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(_read_offers, partitions, [data_dict] * n, [columns] * n, 
+                               [start] * n, [end] * n, [date_column] * n))
+    
+    df = _concat_offers(frames)
+    print(f"Combined {len(df)} records from {len(partitions)} partitions")
+    return df
+
+
+def _select_offers(df, columns=None, start=None, end=None, date_column='offer_viewed_at'):
+    """Keep the rows inside [start, end) on date_column and the requested columns."""
+    if start is not None or end is not None:
+        df = df[_in_window(df[date_column], start, end)].reset_index(drop=True)
+    
+    if columns is not None:
+        # Requested derived features become real columns; everything else stays lazy
+        requested = {col: feature(df, col) for col in columns if col not in df.columns and has_feature(df, col)}
+        df = df.assign(**requested)
+        unknown = [col for col in columns if col not in df.columns]
+        if unknown:
+            raise ValueError(f"Unknown columns requested: {', '.join(unknown)}")
+        df = df[list(columns)]
+    
+    return df
+
+
+def _in_window(dates, start=None, end=None):
+    """Boolean mask of timestamps in [start, end); bounds are localized to the column's timezone."""
+    mask = pd.Series(True, index=dates.index)
+    for bound, keep in [(start, dates.__ge__), (end, dates.__lt__)]:
+        if bound is None:
+            continue
+        bound = pd.Timestamp(bound)
+        if dates.dt.tz is not None and bound.tz is None:
+            bound = bound.tz_localize(dates.dt.tz)
+        mask &= keep(bound)
+    return mask
+
+
+def encode_ids(df):
+    """Replace the entity key columns with nullable Int32 codes in sorted ID order, in place (see decode_ids)."""
+    lookups = _IdLookups()
+    for col in ID_COLUMNS:
+        if col not in df.columns:
+            continue
+        
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            # Categoricals are already factorized; just drop IDs that never occur
+            ids = df[col].cat.remove_unused_categories()
+            codes, uniques = ids.cat.codes.to_numpy(), ids.cat.categories
+        else:
+            codes, uniques = pd.factorize(df[col], sort=True)
+        
+        codes = codes.astype(np.int32)
+        df[col] = pd.arrays.IntegerArray(codes, codes < 0)
+        lookups[col] = pd.Index(uniques, name=col)
     
-    # Create derived columns
-    df['claimed'] = ~df['claimed_at'].isna()
-    df['canceled'] = ~df['canceled_at'].isna()
-    df['deleted'] = ~df['deleted_at'].isna()
+    df.attrs['id_lookups'] = lookups
+    return df
+
+
+class _IdLookups(dict):
+    """Code -> ID lookups of one loaded frame, kept in its attrs.
     
-    # Time-to-decision: how long after viewing does a worker claim a shift?
-    df['decision_time_minutes'] = (df['claimed_at'] - df['offer_viewed_at']).dt.total_seconds() / 60
-    df['decision_time_minutes'] = df['decision_time_minutes'].where(
-        (df['decision_time_minutes'] >= 0) & (df['decision_time_minutes'] < 24*60),  # Filter out unreasonable values
-        np.nan
-    )
+    pandas deep-copies and compares attrs on every operation; the lookups never
+    change after encode_ids, so copies share them and compare by identity
+    (concatenating frames from different loads drops them rather than mixing
+    codes).
+    """
     
-    # Lead time: how far in advance was the shift posted?
-    df['lead_time_days'] = (df['shift_start_at'] - df['shift_created_at']).dt.total_seconds() / (3600 * 24)
-    df['lead_time_days'] = df['lead_time_days'].where(
-        (df['lead_time_days'] >= 0) & (df['lead_time_days'] < 60),  # Filter out unreasonable values
-        np.nan
-    )
+    def __deepcopy__(self, memo):
+        return self
     
-    # Time of day when offer was viewed
-    if 'offer_viewed_at' in df.columns:
-        df['view_hour'] = df['offer_viewed_at'].dt.hour
-        df['view_day_of_week'] = df['offer_viewed_at'].dt.dayofweek  # 0 = Monday, 6 = Sunday
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+
+def decode_ids(table, source=None):
+    """Return a copy of a result table with entity codes mapped back to the IDs of `source` (default: its own)."""
+    lookups = (source if source is not None else table).attrs.get('id_lookups', {})
+    decoded = {}
+    for col in ID_COLUMNS:
+        if col in table.columns and col in lookups and pd.api.types.is_integer_dtype(table[col]):
+            decoded[col] = lookups[col].take(_entity_codes(table[col]), allow_fill=True, fill_value=np.nan)
+    return table.assign(**decoded)
+
+
+def id_count(df, col):
+    """Number of distinct IDs behind a code column of df, for sizing per-entity arrays."""
+    lookups = df.attrs.get('id_lookups', {})
+    if col in lookups:
+        return len(lookups[col])
+    return int(_entity_codes(df[col]).max(initial=-1)) + 1
+
+
+def _entity_codes(ids):
+    """Codes of an encoded ID column, index or array as an int64 array, with -1 for missing IDs."""
+    return pd.array(ids, dtype='Int64').to_numpy(dtype=np.int64, na_value=-1)
+
+
+def interaction_matrix(df, mask=None, rows='worker_id', cols='workplace_id'):
+    """Sparse CSR matrix counting offers per (rows, cols) entity pair, e.g. completed shifts per worker x workplace."""
+    offers = df[[rows, cols]] if mask is None else df.loc[mask, [rows, cols]]
+    row_codes, col_codes = _entity_codes(offers[rows]), _entity_codes(offers[cols])
+    known = (row_codes >= 0) & (col_codes >= 0)
+    counts = sparse.coo_matrix((np.ones(known.sum(), dtype=np.int64), (row_codes[known], col_codes[known])),
+                               shape=(id_count(df, rows), id_count(df, cols)))
+    return counts.tocsr()  # Duplicate pairs are summed into one count
+
+
+def _timeline_order(df, key, order):
+    """Per-entity timelines as (perm, offsets): entity c's rows are perm[offsets[c]:offsets[c + 1]], sorted by `order`."""
+    memo = _frame_memo(df)
+    if ('timeline_order', key, order) not in memo:
+        codes = _entity_codes(df[key])
+        perm = pd.DataFrame({key: codes, order: df[order].array}).sort_values([key, order]).index.to_numpy()
+        offsets = np.searchsorted(codes[perm], np.arange(id_count(df, key) + 1), side='left')
+        memo['timeline_order', key, order] = (perm, offsets)
+    return memo['timeline_order', key, order]
+
+
+def timeline_split(df, key, order, cutoffs, values):
+    """Rows and `values` sums of each entity before and from each of `cutoffs` (timestamps indexed by entity code)."""
+    perm, start, split, end, entities = _timeline_search(df, key, order, cutoffs, side='left')
+    result = pd.DataFrame({key: entities, 'views_before': split - start, 'views_after': end - split})
+    for name, column in values.items():
+        sums = np.concatenate([[0], np.cumsum(np.nan_to_num(np.asarray(column, dtype=np.float64))[perm])])
+        result[f'{name}_before'] = sums[split] - sums[start]
+        result[f'{name}_after'] = sums[end] - sums[split]
+    return result
+
+
+def timeline_as_of(df, key, order, queries, values=None):
+    """Rows, `values` sums and latest `order` time of each entity up to each of `queries` (timestamps by entity code)."""
+    perm, start, position, _, entities = _timeline_search(df, key, order, queries, side='right')
+    result = pd.DataFrame({key: entities, 'as_of': queries.array, 'views': position - start})
+    for name, column in (values or {}).items():
+        sums = np.concatenate([[0], np.cumsum(np.nan_to_num(np.asarray(column, dtype=np.float64))[perm])])
+        result[name] = sums[position] - sums[start]
+    
+    # The latest row at or before the query time is the one just before the search position
+    seen = df[order].take(perm).reset_index(drop=True)
+    result['last_seen_at'] = pd.Series(seen.take(np.maximum(position - 1, 0)).array).where(position > start)
+    return result
+
+
+def _timeline_search(df, key, order, times, side='left'):
+    """Locate (entity, time) pairs in the sorted timelines behind timeline_split and timeline_as_of."""
+    perm, offsets = _timeline_order(df, key, order)
+    entities = _entity_codes(times.index)
+    kept = times.notna().to_numpy() & (entities >= 0)
+    codes = np.where(kept, entities, 0).astype(np.int64)
+    
+    # Rank timestamps so (entity, time) packs into one sorted int64 key; missing times rank last
+    ordered = _epoch_ns(df[order])[perm]
+    valid = ordered != np.iinfo(np.int64).min
+    uniques = np.unique(ordered[valid])
+    stride = len(uniques) + 1
+    ranks = np.where(valid, np.searchsorted(uniques, ordered), len(uniques))
+    keys = _entity_codes(df[key])[perm] * stride + ranks
+    
+    start = offsets[codes]
+    found = np.searchsorted(keys, codes * stride + np.searchsorted(uniques, _epoch_ns(times), side=side), side='left')
+    end = np.searchsorted(keys, codes * stride + len(uniques), side='left')
+    return perm, start, np.where(kept, found, start), np.where(kept, end, start), entities
+
+
+def _epoch_ns(dates):
+    """Timestamps as int64 nanoseconds since the epoch (UTC); NaT becomes the int64 minimum."""
+    return pd.DatetimeIndex(dates).as_unit('ns').asi8
+
+
+def period_codes(dates, period='month'):
+    """Consecutive integer period (day, Monday-based week or month) of each timestamp; NaT becomes -1."""
+    if period not in COHORT_PERIODS:
+        raise ValueError(f"Unknown cohort period {period!r}; expected one of {list(COHORT_PERIODS)}")
+    ns = _epoch_ns(dates)
+    if period == 'month':
+        codes = ns.view('datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+    else:
+        days = ns // (24 * 3600 * 10**9)
+        codes = (days + 3) // 7 if period == 'week' else days  # 1970-01-01 was a Thursday
+    return np.where(ns == np.iinfo(np.int64).min, -1, codes)
+
+
+def period_labels(codes, period='month'):
+    """Readable labels for period codes: 'YYYY-MM' for months, the (Monday) start date for days and weeks."""
+    codes = np.asarray(codes, dtype=np.int64)
+    if period == 'month':
+        return codes.astype('datetime64[M]').astype(str)
+    days = codes * 7 - 3 if period == 'week' else codes
+    return days.astype('datetime64[D]').astype(str)
+
+
+def cohort_matrix(entities, dates, period='month'):
+    """Cohort x age matrix of distinct active entities; ages a cohort has not reached yet are NaN."""
+    entities = _entity_codes(entities)
+    periods = period_codes(dates, period)
+    known = (entities >= 0) & (periods >= 0)
+    entities, periods = entities[known], periods[known]
+    if len(periods) == 0:
+        return pd.DataFrame(index=pd.Index([], name='cohort'), dtype=float)
+    
+    first_period = periods.min()
+    n_periods = int(periods.max() - first_period) + 1
+    
+    # One row per distinct (entity, period) pair, then each entity's first period is its cohort
+    pairs = pd.unique(entities * n_periods + (periods - first_period))
+    entities, periods = pairs // n_periods, pairs % n_periods
+    first = np.full(entities.max() + 1, n_periods)
+    np.minimum.at(first, entities, periods)
+    cohorts = first[entities]
+    
+    counts = np.bincount(cohorts * n_periods + (periods - cohorts), minlength=n_periods * n_periods)
+    counts = counts.reshape(n_periods, n_periods).astype(np.float64)
+    ages = np.arange(n_periods)
+    counts[ages[:, None] + ages[None, :] >= n_periods] = np.nan
+    
+    matrix = pd.DataFrame(counts, index=pd.Index(period_labels(ages + first_period, period), name='cohort'),
+                          columns=pd.RangeIndex(n_periods, name=f'{period}s_since_start'))
+    return matrix[matrix[0] > 0]
+
+
+def concentration_profile(table, rank_by, measures=()):
+    """Rank the rows of `table` by `rank_by`, largest first, with rank_pct and running totals and % of `measures`."""
+    ranked = table.sort_values(rank_by, ascending=False, kind='stable')
+    ranked['rank_pct'] = np.arange(1, len(ranked) + 1) / len(ranked) * 100
+    for col in dict.fromkeys([rank_by, *measures]):
+        cumulative = np.cumsum(ranked[col].fillna(0).to_numpy())
+        total = cumulative[-1] if len(cumulative) else 0
+        ranked[f'cumulative_{col}'] = cumulative
+        ranked[f'cumulative_{col}_pct'] = cumulative / total * 100 if total else 0.0
+    return ranked
+
+
+def entities_for_share(ranked, measure, share_pcts):
+    """% of entities, from the top of a concentration_profile, whose running share of `measure` stays within each %."""
+    counts = np.searchsorted(ranked[f'cumulative_{measure}_pct'].to_numpy(), share_pcts, side='right')
+    return counts / len(ranked) * 100
+
+
+def top_share(ranked, measure, entity_pcts):
+    """Entity counts, totals held and % of the overall total of `measure` for the top X% of a concentration_profile."""
+    counts = (len(ranked) * np.asarray(entity_pcts, dtype=np.float64) / 100).astype(int)
+    cumulative = np.concatenate([[0], ranked[f'cumulative_{measure}'].to_numpy()])
+    held, total = cumulative[counts], cumulative[-1]
+    return counts, held, held / total * 100 if total else np.zeros(len(counts))
+
+
+def _load_data_dictionary():
+    """Load the first data dictionary found in DATA_DICTIONARY_PATHS, or None."""
+    for dict_path in DATA_DICTIONARY_PATHS:
+        if os.path.exists(dict_path):
+            with open(dict_path, 'r') as f:
+                return yaml.safe_load(f)
+    return None
+
+
+def _read_offers(file_path, data_dict=None, columns=None, start=None, end=None, date_column='offer_viewed_at'):
+    """Parse the offer CSV (optionally only some columns and a date window) and add the derived analysis columns."""
+    # Let the data dictionary drive column dtypes when one is available
+    dtypes, datetime_formats, bool_cols = _schema_read_options(file_path, data_dict)
+    
+    usecols = None
+    if columns is not None:
+        sources = _source_columns(columns)
+        usecols = lambda col: col.lower() in sources
+    
+    if start is None and end is None:
+        # Load data
+        df = pd.read_csv(file_path, dtype=dtypes, usecols=usecols)
+        print(f"Columns available: {', '.join(df.columns.str.lower())}")
+        print(f"Loaded {len(df)} records")
+        return _prepare_offers(df, datetime_formats, bool_cols)
+    
+    # Filter each chunk as it is read so rows outside the window are never held
+    chunks = []
+    rows = 0
+    for chunk in pd.read_csv(file_path, dtype=dtypes, usecols=usecols, chunksize=AGGREGATE_CHUNKSIZE):
+        rows += len(chunk)
+        chunk.columns = chunk.columns.str.lower()
+        chunk[date_column] = _parse_datetime(chunk[date_column], datetime_formats.get(date_column))
+        chunk = chunk[_in_window(chunk[date_column], start, end)]
+        chunks.append(_prepare_offers(chunk.copy(), datetime_formats, bool_cols))
+    
+    df = _concat_offers(chunks)
+    print(f"Columns available: {', '.join(df.columns)}")
+    print(f"Loaded {len(df)} of {rows} records between {start or 'the start'} and {end or 'the end'}")
+    return df
+
+
+def _source_columns(columns):
+    """Lowercase source column names needed to produce the requested columns."""
+    sources = set()
+    for col in columns:
+        sources.update(_source_columns(FEATURES[col][1]) if col in FEATURES else [col])
+    if 'rate' in sources:
+        # Older extracts name the pay rate column pay_rate
+        sources.add('pay_rate')
+    return sources
+
+
+def _concat_offers(frames):
+    """Concatenate prepared blocks of offers, keeping categorical columns categorical."""
+    df = pd.concat(frames, ignore_index=True)
+    for col in frames[0].columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            # Blocks carry their own category sets; unify them instead of falling back to object
+            df[col] = union_categoricals([frame[col] for frame in frames], sort_categories=True)
+    return df
+
+
+def _prepare_offers(df, datetime_formats, bool_cols):
+    """Normalize a raw block of offers (a whole file or one chunk) and add the claimed/canceled/deleted flags."""
+    # Normalize column names to lowercase
+    df.columns = df.columns.str.lower()
+
+    # Convert datetime columns
+    for col in DATETIME_COLUMNS:
+        if col in df.columns:
+            df[col] = _parse_datetime(df[col], datetime_formats.get(col))
     
-    # Margin calculation
-    if 'charge_rate' in df.columns and 'rate' in df.columns:
-        df['margin'] = (df['charge_rate'] - df['rate']) / df['charge_rate']
-        df['margin'] = df['margin'].where((df['margin'] > 0) & (df['margin'] < 1), np.nan)
+    # Boolean flags: a missing flag means the event did not happen
+    for col in bool_cols:
+        if col in df.columns:
+            df[col] = df[col].fillna(False).astype(bool)
+
+    # Make sure we have rate column with correct name
+    if 'pay_rate' in df.columns and 'rate' not in df.columns:
+        df['rate'] = df['pay_rate']
     
-    # Total shift value
-    if 'rate' in df.columns and 'duration' in df.columns:
-        df['shift_value'] = df['rate'] * df['duration']
+    # Derived flags (only those whose source columns were read)
+    for name in LOAD_FEATURES:
+        if has_feature(df, name):
+            df[name] = FEATURES[name][0](df)
     
     # Simplify slot names if they're complex
     if 'slot' in df.columns:
         # Map AM/PM/NOC if they have more complex names
+        is_categorical = isinstance(df['slot'].dtype, pd.CategoricalDtype)
+        slot_values = df['slot'].cat.categories if is_categorical else df['slot'].unique()
         slot_mapping = {
             col: 'AM' if isinstance(col, str) and 'AM' in col 
                 else 'PM' if isinstance(col, str) and 'PM' in col 
                 else 'NOC' if isinstance(col, str) and 'NOC' in col 
                 else col
-            for col in df['slot'].unique() if col is not None
+            for col in slot_values if col is not None
         }
-        df['slot'] = df['slot'].map(slot_mapping)
+        if is_categorical:
+            # Remap the categories and keep the per-row codes instead of mapping every row
+            simplified = pd.Categorical(df['slot'].cat.categories.map(slot_mapping))
+            df['slot'] = pd.Series(simplified.take(df['slot'].cat.codes.to_numpy(), allow_fill=True), 
+                                   index=df.index)
+        else:
+            df['slot'] = df['slot'].map(slot_mapping)
     
-    return df, data_dict
+    return df
+
+
+def derived_feature(name, sources):
+    """Register a derived feature computed from `sources` (columns or other features) on first access."""
+    def register(compute):
+        FEATURES[name] = (compute, sources)
+        return compute
+    return register
+
+
+def has_feature(df, name):
+    """Whether df has column `name` or the sources to derive it."""
+    if name in df.columns:
+        return True
+    return name in FEATURES and all(has_feature(df, source) for source in FEATURES[name][1])
+
+
+def feature(df, name):
+    """Column `name` of df, derived from the FEATURES registry and memoized per frame if it is not a real column."""
+    if name in df.columns:
+        return df[name]
+    if name not in FEATURES:
+        raise KeyError(f"Unknown column or derived feature: {name}")
+    
+    memo = _frame_memo(df)
+    if name not in memo:
+        compute, _ = FEATURES[name]
+        memo[name] = compute(df).rename(name)
+    return memo[name]
+
+
+def _frame_memo(df):
+    """Per-frame memo of derived values, dropped when the frame is garbage collected."""
+    memo = _FEATURE_MEMO.get(id(df))
+    if memo is None:
+        memo = _FEATURE_MEMO[id(df)] = {}
+        weakref.finalize(df, _FEATURE_MEMO.pop, id(df), None)
+    return memo
+
+
+@derived_feature('claimed', ['claimed_at'])
+def _claimed(df):
+    return ~df['claimed_at'].isna()
+
+
+@derived_feature('canceled', ['canceled_at'])
+def _canceled(df):
+    return ~df['canceled_at'].isna()
+
+
+@derived_feature('deleted', ['deleted_at'])
+def _deleted(df):
+    return ~df['deleted_at'].isna()
+
+
+@derived_feature('decision_time_minutes', ['claimed_at', 'offer_viewed_at'])
+def _decision_time_minutes(df):
+    """Time-to-decision: how long after viewing does a worker claim a shift?"""
+    minutes = (df['claimed_at'] - df['offer_viewed_at']).dt.total_seconds() / 60
+    return minutes.where((minutes >= 0) & (minutes < 24*60), np.nan)  # Filter out unreasonable values
+
+
+@derived_feature('posting_to_start_days', ['shift_start_at', 'shift_created_at'])
+def _posting_to_start_days(df):
+    """Days between posting a shift and its start, unfiltered."""
+    return (df['shift_start_at'] - df['shift_created_at']).dt.total_seconds() / (3600 * 24)
+
+
+@derived_feature('lead_time_days', ['posting_to_start_days'])
+def _lead_time_days(df):
+    """Lead time: how far in advance was the shift posted?"""
+    days = feature(df, 'posting_to_start_days')
+    return days.where((days >= 0) & (days < 60), np.nan)  # Filter out unreasonable values
+
+
+@derived_feature('view_hour', ['offer_viewed_at'])
+def _view_hour(df):
+    """Time of day when offer was viewed."""
+    return df['offer_viewed_at'].dt.hour
+
+
+@derived_feature('view_day_of_week', ['offer_viewed_at'])
+def _view_day_of_week(df):
+    return df['offer_viewed_at'].dt.dayofweek  # 0 = Monday, 6 = Sunday
+
+
+@derived_feature('margin', ['charge_rate', 'rate'])
+def _margin(df):
+    margin = (df['charge_rate'] - df['rate']) / df['charge_rate']
+    return margin.where((margin > 0) & (margin < 1), np.nan)
+
+
+@derived_feature('shift_value', ['rate', 'duration'])
+def _shift_value(df):
+    """Total shift value."""
+    return df['rate'] * df['duration']
+
+
+@derived_feature('rate_bucket', ['rate'])
+def _rate_bucket(df):
+    return (df['rate'] // RATE_BUCKET_SIZE) * RATE_BUCKET_SIZE
+
+
+@derived_feature('lead_time_bucket', ['lead_time_days'])
+def _lead_time_bucket(df):
+    return pd.cut(feature(df, 'lead_time_days'), bins=LEAD_TIME_BINS, labels=LEAD_TIME_LABELS)
+
+
+@derived_feature('margin_bucket', ['margin'])
+def _margin_bucket(df):
+    return pd.cut(feature(df, 'margin'), bins=MARGIN_BINS, labels=MARGIN_LABELS)
+
+
+@derived_feature('decision_time_bucket', ['decision_time_minutes'])
+def _decision_time_bucket(df):
+    return pd.cut(feature(df, 'decision_time_minutes'), bins=DECISION_TIME_BINS, labels=DECISION_TIME_LABELS)
+
+
+@derived_feature('shift_value_bucket', ['shift_value'])
+def _shift_value_bucket(df):
+    return pd.cut(feature(df, 'shift_value'), bins=SHIFT_VALUE_BINS, labels=SHIFT_VALUE_LABELS)
+
+
+def _file_fingerprint(file_paths, data_dict=None, block_size=1 << 23):
+    """Content hash of the source files (and the schema used to read them), used to key the columnar cache."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"v{CACHE_VERSION}".encode())
+    digest.update(json.dumps(data_dict, sort_keys=True, default=str).encode())
+    for file_path in file_paths:
+        if len(file_paths) > 1:
+            # Partition names are part of the dataset's identity (adding or renaming a day changes it)
+            digest.update(os.path.basename(file_path).encode())
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _schema_read_options(file_path, data_dict):
+    """Translate the data dictionary into read_csv dtypes, datetime formats and boolean columns."""
+    if not data_dict:
+        return None, {}, []
+    
+    # Match dictionary fields against the header case-insensitively
+    header = pd.read_csv(file_path, nrows=0).columns
+    raw_names = {col.lower(): col for col in header}
+    
+    dtypes = {}
+    datetime_formats = {}
+    bool_cols = []
+    for field, spec in data_dict.items():
+        field = field.lower()
+        field_type = (spec or {}).get('type')
+        if field not in raw_names or field_type not in SCHEMA_DTYPES:
+            continue
+        
+        if field_type == 'datetime':
+            datetime_formats[field] = spec.get('format', DATETIME_FORMAT)
+            continue
+        
+        dtypes[raw_names[field]] = 'float64' if field in MONEY_FIELDS else SCHEMA_DTYPES[field_type]
+        if field_type == 'boolean':
+            bool_cols.append(field)
+    
+    return dtypes, datetime_formats, bool_cols
+
+
+def _parse_datetime(values, fmt=None):
+    """Parse timestamps with a fixed format, falling back to inference for non-conforming files."""
+    if fmt is None:
+        return pd.to_datetime(values)
+    try:
+        return pd.to_datetime(values, format=fmt)
+    except (ValueError, TypeError) as e:
+        print(f"Timestamps in {values.name} do not match format {fmt}, inferring instead: {e}")
+        return pd.to_datetime(values)
+
+
+def _write_cache(df, cache_path):
+    """Persist a prepared frame as one .npy file per column plus a manifest."""
+    # Write into a scratch directory first so a crash never leaves a partial cache
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    
+    manifest = {'version': CACHE_VERSION, 'rows': len(df), 'columns': []}
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        entry = {'name': col, 'file': f'{i}.npy', 'dtype': str(series.dtype)}
+        
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            # Store tz-aware timestamps as naive UTC and re-localize on read
+            entry['kind'] = 'datetime_tz'
+            entry['tz'] = str(series.dt.tz)
+            values = series.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+        elif isinstance(series.dtype, pd.CategoricalDtype) or series.to_numpy().dtype == object:
+            # Strings and other Python objects are stored as integer codes + categories
+            entry['kind'] = 'categorical' if isinstance(series.dtype, pd.CategoricalDtype) else 'object'
+            categorical = series if entry['kind'] == 'categorical' else series.astype('category')
+            np.save(tmp_path / f'{i}.categories.npy', 
+                    categorical.cat.categories.to_numpy(dtype=object), allow_pickle=True)
+            values = categorical.cat.codes.to_numpy()
+        else:
+            entry['kind'] = 'array'
+            values = series.to_numpy()
+        
+        np.save(tmp_path / entry['file'], values, allow_pickle=False)
+        manifest['columns'].append(entry)
+    
+    with open(tmp_path / 'manifest.json', 'w') as f:
+        json.dump(manifest, f)
+    
+    # Drop caches of older versions of the same source (same name up to the fingerprint), then publish
+    source = cache_path.name.rsplit('-', 1)[0]
+    for stale in cache_path.parent.iterdir():
+        if stale != tmp_path and stale.name.rsplit('-', 1)[0] == source:
+            shutil.rmtree(stale, ignore_errors=True)
+    tmp_path.rename(cache_path)
+
+
+def _read_cache(cache_path, columns=None):
+    """Rebuild a prepared frame (or just the columns behind the named ones) from its columnar cache."""
+    with open(cache_path / 'manifest.json', 'r') as f:
+        manifest = json.load(f)
+    
+    entries = manifest['columns']
+    if columns is not None:
+        # Derived features are not cached; read the columns they are computed from
+        wanted = set(columns) | _source_columns(columns)
+        entries = [entry for entry in entries if entry['name'] in wanted]
+    
+    columns = {}
+    for entry in entries:
+        values = np.load(cache_path / entry['file'], allow_pickle=False)
+        
+        if entry['kind'] in ('categorical', 'object'):
+            categories = np.load(cache_path / entry['file'].replace('.npy', '.categories.npy'), allow_pickle=True)
+            series = pd.Series(pd.Categorical.from_codes(values, categories=categories))
+            columns[entry['name']] = series if entry['kind'] == 'categorical' else series.astype(entry['dtype'])
+        elif entry['kind'] == 'datetime_tz':
+            columns[entry['name']] = pd.Series(values).dt.tz_localize('UTC').dt.tz_convert(entry['tz'])
+        else:
+            columns[entry['name']] = pd.Series(values)
+    
+    return pd.DataFrame(columns)
+
+
+def stream_aggregates(file_path='data.csv', chunksize=AGGREGATE_CHUNKSIZE, start=None, end=None,
+                      date_column='offer_viewed_at'):
+    """Aggregates behind the core metrics, read in chunks; analyses take them as `aggregates` (df may then be None)."""
+    print(f"Streaming aggregates from {file_path} in chunks of {chunksize:,} rows...")
+
+    data_dict = _load_data_dictionary()
+    windowed = start is not None or end is not None
+
+    pending = []
+    rows = 0
+    for partition in _resolve_partitions(file_path):
+        dtypes, datetime_formats, bool_cols = _schema_read_options(partition, data_dict)
+        for chunk in pd.read_csv(partition, dtype=dtypes, chunksize=chunksize):
+            chunk = _prepare_offers(chunk, datetime_formats, bool_cols)
+            if windowed:
+                # Same [start, end) window as load_data, applied chunk by chunk
+                chunk = chunk[_in_window(chunk[date_column], start, end)]
+                if chunk.empty:
+                    continue
+            rows += len(chunk)
+            _push_partials(pending, _partial_aggregates(chunk))
+            print(f"Aggregated {rows:,} records")
+
+    if not pending:
+        window = f" between {start or 'the start'} and {end or 'the end'}" if windowed else ""
+        raise ValueError(f"No records found in {file_path}{window}")
+
+    return finalize_aggregates(_combine_partials([partial for _, partial in pending]))
+
+
+def _partial_aggregates(chunk):
+    """Reduce one prepared chunk of offers to the partial aggregates in _PARTIAL_AGGREGATES."""
+    rate = chunk['rate'].astype('float64')
+    charge_rate = _optional_feature(chunk, 'charge_rate')
+    margin = _optional_feature(chunk, 'margin')
+    lead_time = feature(chunk, 'lead_time_days').astype('float64')
+
+    # One numeric column per additive quantity, so every table is a plain group-by reduction
+    offers = pd.DataFrame({
+        'worker_id': chunk['worker_id'],
+        'workplace_id': chunk['workplace_id'],
+        'shift_id': chunk['shift_id'],
+        'marketplace': 0,
+        'view_hour': feature(chunk, 'view_hour'),
+        'view_day_of_week': feature(chunk, 'view_day_of_week'),
+        'rate_bucket': feature(chunk, 'rate_bucket'),
+        'lead_time_bucket': feature(chunk, 'lead_time_bucket'),
+        'margin_bucket': pd.cut(margin, bins=MARGIN_BINS, labels=MARGIN_LABELS),
+        'views': _views(chunk),
+        'claims': chunk['claimed'].astype('int64'),
+        'completed': chunk['is_verified'].astype('int64'),
+        'cancellations': chunk['canceled'].astype('int64'),
+        'deleted': chunk['deleted'].astype('int64'),
+        'no_shows': chunk['is_ncns'].astype('int64'),
+        'rate_sum': rate,
+        'rate_count': rate.notna().astype('int64'),
+        'claimed_rate_sum': rate.where(chunk['claimed']),
+        'claimed_rate_count': (rate.notna() & chunk['claimed']).astype('int64'),
+        'earnings': _optional_feature(chunk, 'shift_value').where(chunk['is_verified']),
+        'charge_rate_sum': charge_rate,
+        'charge_rate_count': charge_rate.notna().astype('int64'),
+        'margin_sum': margin,
+        'margin_count': margin.notna().astype('int64'),
+        'lead_time_sum': lead_time,
+        'lead_time_count': lead_time.notna().astype('int64'),
+        'shift_created_at': chunk['shift_created_at']
+    }, index=chunk.index)
+
+    partial = {
+        name: offers.groupby(keys, observed=True).agg(reducers)
+        for name, (keys, reducers) in _PARTIAL_AGGREGATES.items()
+    }
+
+    # Earliest filled shifts per workplace, enough to date every stickiness threshold
+    filled = chunk.loc[chunk['is_verified'], ['workplace_id', 'shift_start_at']]
+    partial['workplace_filled'] = _earliest_filled(filled)
+
+    return partial
+
+
+def _optional_feature(df, col):
+    """Column or derived feature `col` as float64, all NaN when df lacks its sources."""
+    if has_feature(df, col):
+        return feature(df, col).astype('float64')
+    return pd.Series(np.nan, index=df.index)
+
+
+def _views(df):
+    """Views each offer counts for: 1 if it has a shift ID, as in the ('shift_id', 'count') view counts."""
+    if 'shift_id' not in df.columns:
+        return pd.Series(1, index=df.index)
+    return df['shift_id'].notna().astype('int64')
+
+
+def _earliest_filled(filled):
+    """Keep the earliest filled shifts per workplace needed by WORKPLACE_RETENTION_CURVE."""
+    return (filled.sort_values('shift_start_at')
+                  .groupby('workplace_id', observed=True)
+                  .head(max(WORKPLACE_RETENTION_CURVE)))
+
+
+def _combine_partials(partials):
+    """Merge a list of partial aggregate sets into one, with a single group-by per table."""
+    if len(partials) == 1:
+        return partials[0]
+    combined = {}
+    for name, (keys, reducers) in _PARTIAL_AGGREGATES.items():
+        combined[name] = (pd.concat([partial[name] for partial in partials])
+                            .groupby(level=keys, observed=True)
+                            .agg(reducers))
+    combined['workplace_filled'] = _earliest_filled(
+        pd.concat([partial['workplace_filled'] for partial in partials], ignore_index=True))
+    return combined
+
+
+def _push_partials(pending, partial):
+    """Add a chunk's partial aggregates to a stack of (level, partials), merging equal levels like a binary counter."""
+    level = 0
+    while pending and pending[-1][0] == level:
+        partial = _combine_partials([pending.pop()[1], partial])
+        level += 1
+    pending.append((level, partial))
+
+
+def finalize_aggregates(partials):
+    """Turn merged partial aggregates into the tables the analysis functions work from."""
+    # Workers
+    workers = partials['workers']
+    worker_stats = pd.DataFrame({
+        'views': workers['views'],
+        'claims': workers['claims'],
+        'completed': workers['completed'],
+        'cancellations': workers['cancellations'],
+        'no_shows': workers['no_shows'],
+        'avg_rate_viewed': _ratio(workers['rate_sum'], workers['rate_count']),
+        'avg_rate_claimed': _ratio(workers['claimed_rate_sum'], workers['claimed_rate_count']),
+        'total_earnings': workers['earnings']
+    }).rename_axis('worker_id').reset_index()
+
+    # Chunks with missing view times carry float hour/day keys; restore integer keys
+    hours = partials['hours']
+    hours.index = hours.index.astype('int64')
+    hour_metrics = hours[['views', 'claims']].reset_index()
+
+    days = partials['days']
+    days.index = days.index.astype('int64')
+    day_metrics = pd.DataFrame({
+        'views': days['views'],
+        'claims': days['claims'],
+        'avg_rate': _ratio(days['rate_sum'], days['rate_count'])
+    }).reset_index()
+
+    # Shifts by pay-rate bucket
+    rate_buckets = partials['rate_buckets']
+    rate_sensitivity = pd.DataFrame({
+        'view_count': rate_buckets['views'],
+        'claim_count': rate_buckets['claims'],
+        'no_show_count': rate_buckets['no_shows']
+    }).reset_index()
+
+    marketplace = partials['marketplace'].iloc[0]
+
+    return {
+        'worker_stats': worker_stats,
+        'hour_metrics': hour_metrics,
+        'day_metrics': day_metrics,
+        'workplace_features': _workplace_features(partials['workplaces'], partials['shifts']),
+        'workplace_filled': partials['workplace_filled'].reset_index(drop=True),
+        'rate_sensitivity': rate_sensitivity,
+        'lead_time_metrics': _bucket_metrics(partials['lead_time_shifts'], 'lead_time_bucket', LEAD_TIME_LABELS),
+        'margin_metrics': (_bucket_metrics(partials['margin_shifts'], 'margin_bucket', MARGIN_LABELS,
+                                           partials['margin_buckets'])
+                           if marketplace['margin_count'] > 0 else None),
+        'avg_rate': marketplace['rate_sum'] / marketplace['rate_count'],
+        'avg_lead_time': (marketplace['lead_time_sum'] / marketplace['lead_time_count']
+                          if marketplace['lead_time_count'] > 0 else np.nan),
+        'last_shift_created_at': marketplace['shift_created_at']
+    }
+
+
+def _ratio(numerator, denominator):
+    """Mean from a sum and a count, NaN where the count is zero."""
+    return numerator / denominator.where(denominator > 0)
+
+
+def workplace_features(df):
+    """Per-workplace feature table of a loaded frame, built in one fused pass and memoized per frame."""
+    memo = _frame_memo(df)
+    if 'workplace_features' not in memo:
+        rate = df['rate'].astype('float64')
+        charge_rate = _optional_feature(df, 'charge_rate')
+        margin = _optional_feature(df, 'margin')
+        lead_time = _optional_feature(df, 'lead_time_days')
+        offers = pd.DataFrame({
+            'workplace_id': df['workplace_id'],
+            'shift_id': df['shift_id'],
+            'views': _views(df),
+            'claims': df['claimed'].astype('int64'),
+            'completed': df['is_verified'].astype('int64'),
+            'cancellations': df['canceled'].astype('int64'),
+            'deleted': df['deleted'].astype('int64'),
+            'rate_sum': rate,
+            'rate_count': rate.notna().astype('int64'),
+            'charge_rate_sum': charge_rate,
+            'charge_rate_count': charge_rate.notna().astype('int64'),
+            'margin_sum': margin,
+            'margin_count': margin.notna().astype('int64'),
+            'lead_time_sum': lead_time,
+            'lead_time_count': lead_time.notna().astype('int64'),
+            'shift_created_at': df['shift_created_at']
+        }, index=df.index)
+        
+        # Offers without a shift ID still count toward their workplace's totals but form no shift
+        reducers = _PARTIAL_AGGREGATES['workplaces'][1]
+        shifts = offers.groupby(['workplace_id', 'shift_id'], observed=True, dropna=False).agg(reducers)
+        workplaces = shifts.groupby(level='workplace_id', observed=True).agg(reducers)
+        known = shifts.index.get_level_values('shift_id').notna()
+        memo['workplace_features'] = _workplace_features(workplaces, shifts[known])
+    return memo['workplace_features']
+
+
+def _workplace_features(workplaces, shifts):
+    """Workplace feature table from per-workplace and per-shift sums (see workplace_features)."""
+    by_workplace = lambda values: values.groupby(level='workplace_id', observed=True)
+    features = pd.DataFrame({
+        'shifts_posted': by_workplace(shifts).size(),
+        'views_received': workplaces['views'],
+        'shifts_claimed': workplaces['claims'],
+        'shifts_completed': workplaces['completed'],
+        'shifts_cancelled': workplaces['cancellations'],
+        'shifts_deleted': workplaces['deleted'],
+        'avg_rate': _ratio(workplaces['rate_sum'], workplaces['rate_count']),
+        'avg_charge_rate': _ratio(workplaces['charge_rate_sum'], workplaces['charge_rate_count']),
+        'avg_margin': _ratio(workplaces['margin_sum'], workplaces['margin_count'])
+    }).rename_axis('workplace_id').reset_index()
+    
+    features['view_per_shift'] = features['views_received'] / features['shifts_posted']
+    features['claim_rate'] = features['shifts_claimed'] / features['views_received']
+    features['fill_rate'] = features['shifts_completed'] / features['shifts_posted']
+    features['cancellation_rate'] = features['shifts_cancelled'] / features['shifts_claimed']
+    features['deletion_rate'] = features['shifts_deleted'] / features['shifts_posted']
+    
+    # Offer-weighted lead time, spread of per-shift average rates, shifts with a deletion and latest post
+    ids = features['workplace_id']
+    features['avg_lead_time'] = _ratio(workplaces['lead_time_sum'], workplaces['lead_time_count']).reindex(ids).to_numpy()
+    features['lead_time_count'] = workplaces['lead_time_count'].reindex(ids).to_numpy()
+    features['rate_std'] = by_workplace(_ratio(shifts['rate_sum'], shifts['rate_count'])).std().reindex(ids).to_numpy()
+    features['deleted_shifts'] = by_workplace(shifts['deleted'] > 0).sum().reindex(ids).to_numpy()
+    features['latest_post'] = workplaces['shift_created_at'].reindex(ids).to_numpy()
+    return features
+
+
+def shift_facts(df):
+    """Per-shift fact table (offer counts, rates, workplace, slot, lead time) of an offer frame, memoized per frame."""
+    memo = _frame_memo(df)
+    if 'shift_facts' not in memo:
+        flag = lambda name: feature(df, name).fillna(False).astype('int64') if has_feature(df, name) else 0
+        rate = _optional_feature(df, 'rate')
+        offers = pd.DataFrame({
+            'shift_id': df['shift_id'],
+            'views': 1,
+            'claims': flag('claimed'),
+            'completed': flag('is_verified'),
+            'cancellations': flag('canceled'),
+            'deleted': flag('deleted'),
+            'no_shows': flag('is_ncns'),
+            'rate': rate,
+            'posting_to_start_days': _optional_feature(df, 'posting_to_start_days'),
+            'lead_time_days': _optional_feature(df, 'lead_time_days')
+        }, index=df.index)
+        for col in ['workplace_id', 'slot']:
+            offers[col] = df[col] if col in df.columns else np.nan
+        if 'offer_viewed_at' in df.columns:
+            offers = offers.loc[df['offer_viewed_at'].sort_values(kind='stable').index]
+        
+        memo['shift_facts'] = offers.groupby('shift_id', observed=True).agg(
+            workplace_id=('workplace_id', 'first'),
+            slot=('slot', 'first'),
+            views=('views', 'sum'),
+            claims=('claims', 'sum'),
+            completed=('completed', 'sum'),
+            cancellations=('cancellations', 'sum'),
+            deleted=('deleted', 'sum'),
+            no_shows=('no_shows', 'sum'),
+            rate_count=('rate', 'count'),
+            min_rate=('rate', 'min'),
+            max_rate=('rate', 'max'),
+            first_rate=('rate', 'first'),
+            last_rate=('rate', 'last'),
+            posting_to_start_days=('posting_to_start_days', 'first'),
+            lead_time_days=('lead_time_days', 'first')
+        ).reset_index()
+    return memo['shift_facts']
+
+
+def funnel(df, dimensions, mask=None, shifts=False):
+    """View -> claim -> verify/cancel/no-show funnel for every combination of `dimensions`."""
+    dimensions = list(dimensions)
+    rate = _optional_feature(df, 'rate')
+    offers = pd.DataFrame({dim: feature(df, dim) for dim in dimensions}, index=df.index)
+    offers['views'] = _views(df)
+    for stage, flag in FUNNEL_STAGES.items():
+        offers[stage] = feature(df, flag).fillna(False).astype('int64') if has_feature(df, flag) else 0
+    offers['rate_sum'] = rate
+    offers['rate_count'] = rate.notna().astype('int64')
+    if shifts:
+        offers['shift_id'] = df['shift_id']
+    if mask is not None:
+        offers = offers[mask]
+    
+    # Offers missing a dimension are left out; with shifts, offers without a shift ID still count in every
+    # stage but form no shift
+    if shifts:
+        per_shift = offers.groupby(dimensions + ['shift_id'], observed=True, dropna=False).sum()
+        per_shift['shifts'] = per_shift.index.get_level_values('shift_id').notna().astype('int64')
+        stages = per_shift.groupby(level=dimensions, observed=True).sum()
+    else:
+        stages = offers.groupby(dimensions, observed=True).sum()
+    stages = _with_empty_buckets(stages, offers.dtypes)
+    return _funnel_rates(stages, shifts).reset_index()
+
+
+def _with_empty_buckets(stages, dtypes):
+    """Stage counts with a zero row for every empty bucket of the ordered categorical (bucket) dimensions."""
+    dimensions = list(stages.index.names)
+    buckets = [dim for dim in dimensions if isinstance(dtypes[dim], pd.CategoricalDtype) and dtypes[dim].ordered]
+    if not buckets:
+        return stages
+    levels = [pd.CategoricalIndex(dtypes[dim].categories, dtype=dtypes[dim]) if dim in buckets
+              else stages.index.get_level_values(dim).unique().sort_values() for dim in dimensions]
+    index = pd.MultiIndex.from_product(levels, names=dimensions)
+    if not isinstance(stages.index, pd.MultiIndex):
+        index = index.get_level_values(0)
+    return stages.reindex(index, fill_value=0)
+
+
+def _funnel_rates(stages, shifts=False):
+    """Funnel table from summed stage counts and rate sums/counts."""
+    result = stages[(['shifts'] if shifts else []) + ['views', *FUNNEL_STAGES]].copy()
+    result['avg_rate'] = _ratio(stages['rate_sum'], stages['rate_count'])
+    result['claim_rate'] = result['claims'] / result['views']
+    for stage, rate_name in [('completions', 'completion_rate'), ('cancellations', 'cancellation_rate'),
+                             ('no_shows', 'no_show_rate')]:
+        result[rate_name] = result[stage] / result['claims']
+    if shifts:
+        result['view_per_shift'] = result['views'] / result['shifts']
+        result['fill_rate'] = result['completions'] / result['shifts']
+    return result
+
+
+def offer_cube(df, dimensions=CUBE_DIMENSIONS):
+    """Dense cube of funnel counts over every combination of `dimensions`, memoized per frame."""
+    dimensions = [dim for dim in dimensions if has_feature(df, dim)]
+    memo = _frame_memo(df)
+    key = ('offer_cube', tuple(dimensions))
+    if key not in memo:
+        levels, codes = {}, []
+        for dim in dimensions:
+            values = feature(df, dim)
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                dim_codes, dim_levels = values.cat.codes.to_numpy(), pd.CategoricalIndex(
+                    values.cat.categories, categories=values.cat.categories, ordered=values.cat.ordered)
+            else:
+                dim_codes, dim_levels = pd.factorize(values, sort=True)
+            dim_codes = np.where(dim_codes < 0, len(dim_levels), dim_codes)
+            levels[dim] = pd.Index(dim_levels, name=dim)
+            codes.append(dim_codes)
+        shape = tuple(len(levels[dim]) + 1 for dim in dimensions)
+        cell = np.ravel_multi_index(codes, shape) if dimensions else np.zeros(len(df), dtype=np.int64)
+        size = int(np.prod(shape))
+        
+        rate = _optional_feature(df, 'rate').to_numpy(dtype=np.float64)
+        measures = {'offers': None, 'views': _views(df).to_numpy(dtype=np.float64)}
+        for stage, flag in FUNNEL_STAGES.items():
+            measures[stage] = (feature(df, flag).fillna(False).to_numpy(dtype=np.float64) if has_feature(df, flag)
+                               else np.zeros(len(df)))
+        measures['rate_sum'] = np.nan_to_num(rate)
+        measures['rate_count'] = (~np.isnan(rate)).astype(np.float64)
+        
+        counts = np.stack([np.bincount(cell, weights=weights, minlength=size) for weights in measures.values()],
+                          axis=-1)
+        memo[key] = {
+            'dimensions': dimensions,
+            'levels': levels,
+            'measures': list(measures),
+            'counts': counts.reshape(shape + (len(measures),))
+        }
+    return memo[key]
+
+
+def cube_query(cube, dimensions, where=None):
+    """Funnel table for `dimensions` summed from an offer_cube over the `where` levels (the cube skips underivable dimensions)."""
+    dimensions = list(dimensions)
+    unknown = [dim for dim in dimensions + list(where or {}) if dim not in cube['dimensions']]
+    if unknown:
+        raise KeyError(f"Dimensions {unknown} are not in the cube; available: {cube['dimensions']}")
+    for dim, values in (where or {}).items():
+        missing = [value for value in values if value not in cube['levels'][dim]]
+        if missing:
+            raise ValueError(f"Unknown {dim} levels {missing}; available: {list(cube['levels'][dim])}")
+    counts = cube['counts']
+    positions = {}
+    for axis, dim in enumerate(cube['dimensions']):
+        # Requested and filtered dimensions keep only their real levels (dropping the missing level)
+        if where is not None and dim in where:
+            positions[dim] = np.flatnonzero(cube['levels'][dim].isin(where[dim]))
+        elif dim in dimensions:
+            positions[dim] = np.arange(len(cube['levels'][dim]))
+        if dim in positions:
+            counts = counts.take(positions[dim], axis=axis)
+    
+    # Sum out the other dimensions and order the remaining axes as requested
+    kept = [dim for dim in cube['dimensions'] if dim in dimensions]
+    counts = counts.sum(axis=tuple(axis for axis, dim in enumerate(cube['dimensions']) if dim not in dimensions))
+    counts = np.moveaxis(counts, [kept.index(dim) for dim in dimensions], range(len(dimensions)))
+    
+    index = pd.MultiIndex.from_product([cube['levels'][dim][positions[dim]] for dim in dimensions])
+    stages = pd.DataFrame(counts.reshape(-1, counts.shape[-1]), index=index, columns=cube['measures'])
+    stages = stages[stages['offers'] > 0].astype({name: 'int64' for name in ['views', *FUNNEL_STAGES]})
+    stages = _with_empty_buckets(stages, {dim: cube['levels'][dim].dtype for dim in dimensions})
+    return _funnel_rates(stages).reset_index()
+
+
+def time_index(df, freq='day'):
+    """Prefix sums of the marketplace counters per day or hour of offer_viewed_at, memoized per frame."""
+    if freq not in TIME_INDEX_FREQS:
+        raise ValueError(f"Unknown time index frequency {freq!r}; expected one of {list(TIME_INDEX_FREQS)}")
+    memo = _frame_memo(df)
+    key = ('time_index', freq)
+    if key not in memo:
+        step = TIME_INDEX_FREQS[freq]
+        ns = _epoch_ns(df['offer_viewed_at'])
+        viewed = ns != np.iinfo(np.int64).min
+        codes = ns[viewed] // step
+        first = int(codes.min()) if len(codes) else 0
+        buckets = codes - first
+        n_buckets = int(buckets.max()) + 1 if len(buckets) else 0
+        
+        measures = {'views': _views(df).to_numpy(dtype=np.float64)}
+        for stage, flag in {**FUNNEL_STAGES, 'deletions': 'deleted'}.items():
+            measures[stage] = (feature(df, flag).fillna(False).to_numpy(dtype=np.float64) if has_feature(df, flag)
+                               else np.zeros(len(df)))
+        for col in ['rate', 'charge_rate', 'margin']:
+            values = _optional_feature(df, col).to_numpy(dtype=np.float64)
+            measures[f'{col}_sum'] = np.nan_to_num(values)
+            measures[f'{col}_count'] = (~np.isnan(values)).astype(np.float64)
+        totals = {name: np.bincount(buckets, weights=values[viewed], minlength=n_buckets)
+                  for name, values in measures.items()}
+        
+        # A shift is counted once, in the bucket it was first viewed in; offers with a
+        # missing shift ID belong to no shift
+        shift_codes = _entity_codes(df['shift_id'])[viewed]
+        known = shift_codes >= 0
+        first_view = pd.Series(buckets[known]).groupby(shift_codes[known]).min().to_numpy()
+        totals['shifts'] = np.bincount(first_view, minlength=n_buckets).astype(np.float64)
+        
+        prefix = np.zeros((n_buckets + 1, len(totals)))
+        np.cumsum(np.stack(list(totals.values()), axis=-1), axis=0, out=prefix[1:])
+        memo[key] = {
+            'freq': freq,
+            'step': step,
+            'first': first,
+            'tz': df['offer_viewed_at'].dt.tz,
+            'measures': list(totals),
+            'prefix': prefix
+        }
+    return memo[key]
+
+
+def _bucket_positions(index, bounds, default):
+    """Prefix row of each bound: the first bucket starting at or after it, clipped to the index."""
+    if bounds is None:
+        return np.array([default])
+    dates = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(bounds)))
+    if index['tz'] is not None and dates.tz is None:
+        dates = dates.tz_localize(index['tz'])
+    positions = -(-dates.as_unit('ns').asi8 // index['step']) - index['first']
+    return np.clip(positions, 0, len(index['prefix']) - 1)
+
+
+def window_kpis(index, start=None, end=None):
+    """Marketplace counters and KPIs for the windows [start, end) of a time_index, one row per window."""
+    prefix = index['prefix']
+    lower, upper = np.broadcast_arrays(_bucket_positions(index, start, 0),
+                                       _bucket_positions(index, end, len(prefix) - 1))
+    upper = np.maximum(upper, lower)
+    totals = pd.DataFrame(prefix[upper] - prefix[lower], columns=index['measures'])
+    
+    boundaries = lambda positions: pd.to_datetime(
+        (index['first'] + positions) * index['step'], utc=True).tz_convert(index['tz'])
+    result = pd.DataFrame({'start': boundaries(lower), 'end': boundaries(upper)})
+    for name in ['shifts', 'views', *FUNNEL_STAGES, 'deletions']:
+        result[name] = totals[name].round().astype('int64')
+    result['claim_rate'] = _ratio(totals['claims'], totals['views'])
+    result['fill_rate'] = _ratio(totals['completions'], totals['shifts'])
+    for col in ['rate', 'charge_rate', 'margin']:
+        result[f'avg_{col}'] = _ratio(totals[f'{col}_sum'], totals[f'{col}_count'])
+    return result
+
+
+def _bucket_metrics(bucket_shifts, bucket, labels, bucket_totals=None):
+    """Shift, view, claim and completion counts for every bucket label, in label order."""
+    grouped = bucket_shifts.groupby(level=bucket, observed=True)
+    totals = grouped.sum() if bucket_totals is None else bucket_totals
+    metrics = pd.DataFrame({
+        'shifts': grouped.size(),
+        'views': totals['views'],
+        'claims': totals['claims'],
+        'completions': totals['completed']
+    })
+    metrics = metrics.reindex(labels).fillna(0).astype('int64')
+    metrics.index = pd.CategoricalIndex(metrics.index, categories=labels, ordered=True, name=bucket)
+    return metrics.reset_index()
+
+
+def append_to_store(file_path, store_dir=STORE_DIR):
+    """Append the partitions of `file_path` not yet in the store and return its updated aggregates."""
+    store_dir = Path(store_dir)
+    manifest = _read_store_manifest(store_dir)
+    if manifest['version'] != CACHE_VERSION:
+        raise ValueError(f"Store {store_dir} was built by an older version of the analysis; delete it to rebuild")
+    partials = _read_store_partials(store_dir) if manifest['partitions'] else None
+    ingested = {entry['name']: entry['fingerprint'] for entry in manifest['partitions']}
+
+    data_dict = _load_data_dictionary()
+    for partition in _resolve_partitions(file_path):
+        name = os.path.basename(partition)
+        fingerprint = _file_fingerprint([partition], data_dict)
+        if ingested.get(name) == fingerprint:
+            continue
+        if name in ingested:
+            print(f"Error: {name} is already in the store with different contents, skipping it "
+                  f"(delete {store_dir} to rebuild)")
+            continue
+
+        print(f"Appending {partition} to store {store_dir}...")
+        df = _read_offers(partition, data_dict)
+        block = f"{len(manifest['partitions']):05d}-{fingerprint}"
+        _write_cache(df, store_dir / 'offers' / block)
+
+        partial = _partial_aggregates(df)
+        partials = partial if partials is None else _combine_partials([partials, partial])
+        manifest['partitions'].append({'name': name, 'fingerprint': fingerprint, 'block': block, 'rows': len(df)})
+        ingested[name] = fingerprint
+
+        # Persist after every partition so an interrupted run keeps what it finished
+        _write_store(partials, manifest, store_dir)
+
+    if partials is None:
+        raise ValueError(f"No records in store {store_dir}")
+
+    print(f"Store holds {sum(entry['rows'] for entry in manifest['partitions']):,} records "
+          f"from {len(manifest['partitions'])} partitions")
+    return finalize_aggregates(partials)
+
+
+def load_store(store_dir=STORE_DIR):
+    """Load every offer appended to the store as one prepared frame (IDs encoded as in load_data)."""
+    store_dir = Path(store_dir)
+    manifest = _read_store_manifest(store_dir)
+    if not manifest['partitions']:
+        raise ValueError(f"No records in store {store_dir}")
+
+    frames = [_read_cache(store_dir / 'offers' / entry['block']) for entry in manifest['partitions']]
+    df = _concat_offers(frames)
+    print(f"Loaded {len(df)} records from store {store_dir}")
+    return encode_ids(df)
+
+
+def _store_aggregates_dir(store_dir):
+    """Current aggregates directory of a store, recovering from an interrupted swap."""
+    aggregates_dir = Path(store_dir) / 'aggregates'
+    old_dir = aggregates_dir.with_name('aggregates.old')
+    if not aggregates_dir.exists() and old_dir.exists():
+        return old_dir
+    return aggregates_dir
+
+
+def _read_store_manifest(store_dir):
+    """List of partitions appended to a store, empty for a new store."""
+    manifest_path = _store_aggregates_dir(store_dir) / 'manifest.json'
+    if not manifest_path.exists():
+        return {'version': CACHE_VERSION, 'partitions': []}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def _read_store_partials(store_dir):
+    """Load a store's merged partial aggregates."""
+    aggregates_dir = _store_aggregates_dir(store_dir)
+    return {name: pd.read_pickle(aggregates_dir / f'{name}.pkl')
+            for name in list(_PARTIAL_AGGREGATES) + ['workplace_filled']}
+
+
+def _write_store(partials, manifest, store_dir):
+    """Persist merged partial aggregates together with the manifest they reflect."""
+    aggregates_dir = Path(store_dir) / 'aggregates'
+    tmp_dir = aggregates_dir.with_name('aggregates.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for name, table in partials.items():
+        table.to_pickle(tmp_dir / f'{name}.pkl')
+    with open(tmp_dir / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    
+    old_dir = aggregates_dir.with_name('aggregates.old')
+    if aggregates_dir.exists():
+        shutil.rmtree(old_dir, ignore_errors=True)
+        aggregates_dir.rename(old_dir)
+    tmp_dir.rename(aggregates_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def segment_model(features, scaler, centroids, names, X):
+    """Build a persistable segmentation model from a fitted scaler, scaled centroids and the features X it was fit on."""
+    model = {
+        'version': SEGMENT_MODEL_VERSION,
+        'features': list(features),
+        'mean': scaler.mean_.tolist(),
+        'scale': scaler.scale_.tolist(),
+        'centroids': np.asarray(centroids, dtype=float).tolist(),
+        'names': list(names),
+        'fitted_at': datetime.now().isoformat(timespec='seconds'),
+        'fitted_rows': len(X)
+    }
+    model['baseline_distance'] = assign_segments(model, X)[1]
+    return model
+
+
+def scale_segment_features(model, X):
+    """Standardize a feature matrix with a model's persisted scaler."""
+    return (np.asarray(X, dtype=float) - np.asarray(model['mean'])) / np.asarray(model['scale'])
+
+
+def assign_segments(model, X):
+    """Assign each row of X to its nearest centroid, returning the labels and mean squared distance."""
+    X_scaled = scale_segment_features(model, X)
+    centroids = np.asarray(model['centroids'])
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, without materializing rows x centroids x features
+    distances = (X_scaled ** 2).sum(axis=1)[:, None] - 2 * X_scaled @ centroids.T + (centroids ** 2).sum(axis=1)
+    labels = distances.argmin(axis=1)
+    nearest = np.maximum(distances[np.arange(len(labels)), labels], 0)
+    return labels, float(nearest.mean()) if len(nearest) else 0.0
+
+
+def load_segment_model(name, features, X, model_dir=SEGMENT_MODEL_DIR):
+    """Load segmentation model `name` and assign the rows of X, or (None, None) if it is missing, stale or drifted."""
+    model_path = Path(model_dir) / f'{name}.json'
+    if not model_path.exists():
+        return None, None
+    with open(model_path, 'r') as f:
+        model = json.load(f)
+    if model.get('version') != SEGMENT_MODEL_VERSION or model['features'] != list(features):
+        print(f"Saved {name} segment model does not match the current features; refitting")
+        return None, None
+    
+    labels, distance = assign_segments(model, X)
+    drift = distance / model['baseline_distance'] if model['baseline_distance'] > 0 else np.inf
+    if drift > SEGMENT_DRIFT_TOLERANCE:
+        print(f"{name.capitalize()} segments have drifted ({drift:.2f}x the fitted distance); refitting")
+        return None, None
+    
+    print(f"Assigned {len(labels)} {name} to the {len(model['names'])} segments fit on {model['fitted_at']}")
+    return model, labels
+
+
+def save_segment_model(name, model, model_dir=SEGMENT_MODEL_DIR):
+    """Persist a segmentation model so later runs assign to the same segments."""
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = model_dir / f'{name}.json.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(model, f, indent=2)
+    tmp_path.replace(model_dir / f'{name}.json')
 
 
 def key_metrics_summary(df, worker_stats, workplace_stats):
     """Generate summary of key marketplace metrics."""
     print("Generating key metrics summary...")
+    total_shifts = len(shift_facts(df))
     
     # Create a dataframe with key metrics
     metrics = []
@@ -146,7 +1541,7 @@ def key_metrics_summary(df, worker_stats, workplace_stats):
     metrics.append({
         'category': 'Marketplace',
         'metric': 'Total Shifts Posted',
-        'value': df['shift_id'].nunique()
+        'value': total_shifts
     })
     metrics.append({
         'category': 'Marketplace',
@@ -161,7 +1556,7 @@ def key_metrics_summary(df, worker_stats, workplace_stats):
     metrics.append({
         'category': 'Marketplace',
         'metric': 'Overall Fill Rate',
-        'value': df['is_verified'].sum() / df['shift_id'].nunique()
+        'value': df['is_verified'].sum() / total_shifts
     })
     metrics.append({
         'category': 'Marketplace',
@@ -178,7 +1573,7 @@ def key_metrics_summary(df, worker_stats, workplace_stats):
         metrics.append({
             'category': 'Marketplace',
             'metric': 'Average Margin',
-            'value': df['margin'].mean()
+            'value': feature(df, 'margin').mean()
         })
     
     # Worker metrics
@@ -280,11 +1675,12 @@ def generate_detailed_analysis(df, worker_stats=None, workplace_stats=None, pric
     most_active_hour = "Unknown"
     highest_conv_hour = "Unknown"
     
-    if 'view_hour' in df.columns:
+    if has_feature(df, 'view_hour'):
         # Calculate hourly claim volumes and rates
-        hourly_claims = df.groupby('view_hour')['claimed'].sum()
-        hourly_views = df.groupby('view_hour').size()
-        hourly_rates = df.groupby('view_hour')['claimed'].mean()
+        view_hour = feature(df, 'view_hour')
+        hourly_claims = df.groupby(view_hour)['claimed'].sum()
+        hourly_views = df.groupby(view_hour).size()
+        hourly_rates = df.groupby(view_hour)['claimed'].mean()
         
         # Find most active booking time (highest claim volume)
         if not hourly_claims.empty:
@@ -350,14 +1746,14 @@ def generate_detailed_analysis(df, worker_stats=None, workplace_stats=None, pric
 - Experience correlation with cancellation rate: {:.2f} (negative correlation indicates lower cancellations with experience)
 """.format(
         df['claimed'].mean(),
-        df['decision_time_minutes'].median() if 'decision_time_minutes' in df.columns else 0,
+        feature(df, 'decision_time_minutes').median() if has_feature(df, 'decision_time_minutes') else 0,
         worker_stats[worker_stats['claims'] == 1]['claim_rate'].mean() if worker_stats is not None and not worker_stats.empty and 'claims' in worker_stats.columns and 'claim_rate' in worker_stats.columns else 0,
         worker_stats[worker_stats['claims'] >= 5]['claim_rate'].mean() if worker_stats is not None and not worker_stats.empty and 'claims' in worker_stats.columns and 'claim_rate' in worker_stats.columns else 0,
         worker_stats.nlargest(int(len(worker_stats) * 0.1), 'total_earnings')['completed'].sum() / df['is_verified'].sum() if worker_stats is not None and not worker_stats.empty and 'total_earnings' in worker_stats.columns and 'completed' in worker_stats.columns and df['is_verified'].sum() > 0 else 0,
         worker_stats[worker_stats['is_power_worker']]['completion_rate'].mean() - worker_stats['completion_rate'].mean() if worker_stats is not None and not worker_stats.empty and 'is_power_worker' in worker_stats.columns and 'completion_rate' in worker_stats.columns else 0,
         power_worker_low_rate_factor,
-        df[df['view_hour'].between(6, 11)]['claimed'].mean() if 'view_hour' in df.columns else 0,
-        df[df['view_hour'].between(18, 23)]['claimed'].mean() if 'view_hour' in df.columns else 0,
+        df[feature(df, 'view_hour').between(6, 11)]['claimed'].mean() if has_feature(df, 'view_hour') else 0,
+        df[feature(df, 'view_hour').between(18, 23)]['claimed'].mean() if has_feature(df, 'view_hour') else 0,
         most_active_hour,
         highest_conv_hour,
         worker_stats[worker_stats['claims'] == 1]['claim_rate'].mean() if worker_stats is not None and not worker_stats.empty and 'claims' in worker_stats.columns and 'claim_rate' in worker_stats.columns else 0,
@@ -600,8 +1996,8 @@ def generate_detailed_analysis(df, worker_stats=None, workplace_stats=None, pric
   2. {}
   3. {}
 """.format(
-        df['is_verified'].sum() / df['shift_id'].nunique() if df['shift_id'].nunique() > 0 else 0,
-        df['shift_id'].nunique() / workplace_stats['workplace_id'].nunique() if workplace_stats is not None and not workplace_stats.empty and 'workplace_id' in workplace_stats.columns else 0,
+        df['is_verified'].sum() / len(shift_facts(df)) if len(shift_facts(df)) > 0 else 0,
+        len(shift_facts(df)) / workplace_stats['workplace_id'].nunique() if workplace_stats is not None and not workplace_stats.empty and 'workplace_id' in workplace_stats.columns else 0,
         workplace_stats.nlargest(int(len(workplace_stats) * 0.2), 'shifts_posted')['shifts_posted'].sum() / workplace_stats['shifts_posted'].sum() if workplace_stats is not None and not workplace_stats.empty and 'shifts_posted' in workplace_stats.columns else 0,
         len(workplace_stats[workplace_stats['fill_rate'] > 0.8]) / len(workplace_stats) if workplace_stats is not None and not workplace_stats.empty and 'fill_rate' in workplace_stats.columns else 0,
         returning_workers_pct,
@@ -730,9 +2126,12 @@ def generate_detailed_analysis(df, worker_stats=None, workplace_stats=None, pric
             fill_advance = lead_time_metrics[lead_time_metrics['lead_time_days'] > 7]['is_filled'].mean()
     else:
         # Calculate directly from main dataframe if available
-        if 'lead_time_days' in df.columns and 'is_verified' in df.columns:
+        if has_feature(df, 'lead_time_days') and 'is_verified' in df.columns:
             # Group by shift_id to avoid double-counting
-            shift_data = df.groupby('shift_id').agg({
+            shift_data = pd.DataFrame({
+                'lead_time_days': feature(df, 'lead_time_days'),
+                'is_verified': df['is_verified']
+            }).groupby(df['shift_id'], observed=True).agg({
                 'lead_time_days': 'first',
                 'is_verified': 'max'  # If any view led to verification
             })
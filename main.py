@@ -6,11 +6,13 @@ Main execution script for Clipboard Health marketplace analysis
 """
 
 import os
+import argparse
 import pandas as pd
 from datetime import datetime
 from pathlib import Path
 
-from core import load_data, key_metrics_summary, generate_detailed_analysis, OUTPUT_DIR
+from core import (load_data, stream_aggregates, append_to_store, key_metrics_summary, generate_detailed_analysis, 
+                  feature, has_feature, shift_facts, OUTPUT_DIR, AGGREGATE_CHUNKSIZE, STORE_DIR, COHORT_PERIODS)
 from ai_analysis import generate_o1_summary
 from worker_analysis import worker_metrics, worker_segmentation, worker_retention_analysis, first_booking_analysis
 from workplace_analysis import workplace_metrics, repeat_booking_analysis, shift_deletion_analysis
@@ -26,14 +28,14 @@ from shift_analysis import (
 )
 
 
-def main():
+def main(data_path='data.csv', start=None, end=None, refit_segments=False, cohort_period='month'):
     """Execute the full analysis workflow."""
     print("Starting Comprehensive Marketplace Analysis...")
     start_time = datetime.now()
     
     try:
         # Load data
-        df, data_dict = load_data()
+        df, data_dict = load_data(data_path, start=start, end=end)
     except Exception as e:
         print(f"Error loading data: {e}")
         return
@@ -105,7 +107,7 @@ def main():
     # Worker segmentation
     # Addresses questions about power workers, worker clustering, and marketplace concentration
     try:
-        worker_segments = worker_segmentation(df, worker_stats)
+        worker_segments = worker_segmentation(df, worker_stats, refit_segments=refit_segments)
     except Exception as e:
         print(f"Error in worker_segmentation: {e}")
         worker_segments = None
@@ -113,7 +115,7 @@ def main():
     # Workplace metrics
     # Addresses questions about problematic workplaces, workplace concentration, and risk
     try:
-        workplace_stats = workplace_metrics(df)
+        workplace_stats = workplace_metrics(df, refit_segments=refit_segments)
     except Exception as e:
         print(f"Error in workplace_metrics: {e}")
         workplace_stats = None
@@ -175,7 +177,7 @@ def main():
     # Worker retention analysis
     # Addresses questions about worker churn and retention patterns
     try:
-        retention_metrics = worker_retention_analysis(df, worker_stats)
+        retention_metrics = worker_retention_analysis(df, worker_stats, period=cohort_period)
     except Exception as e:
         print(f"Error in worker_retention_analysis: {e}")
         retention_metrics = None
@@ -210,21 +212,22 @@ def main():
         
     # Generate summary report with key findings
     try:
+        total_shifts = len(shift_facts(df))
         summary_report = f"""# Clipboard Health Marketplace Analysis
 
 ## Key Metrics
 
-- Total Shifts Posted: {df['shift_id'].nunique():,}
+- Total Shifts Posted: {total_shifts:,}
 - Total Workers: {worker_stats['worker_id'].nunique() if worker_stats is not None and 'worker_id' in worker_stats.columns else 'N/A'}
 - Total Workplaces: {workplace_stats['workplace_id'].nunique() if workplace_stats is not None and 'workplace_id' in workplace_stats.columns else 'N/A'}
 - Overall Claim Rate: {df['claimed'].mean():.2%}
-- Overall Fill Rate: {df['is_verified'].sum() / df['shift_id'].nunique():.2%}
+- Overall Fill Rate: {df['is_verified'].sum() / total_shifts:.2%}
 - Average Pay Rate: ${df['rate'].mean():.2f}
-{"- Average Margin: " + f"{df['margin'].mean():.2%}" if 'margin' in df.columns else ""}
+{"- Average Margin: " + f"{feature(df, 'margin').mean():.2%}" if has_feature(df, 'margin') else ""}
 
 ## Key Insights
 
-1. The marketplace shows a claim rate of {df['claimed'].mean():.2%} and a fill rate of {df['is_verified'].sum() / df['shift_id'].nunique():.2%}.
+1. The marketplace shows a claim rate of {df['claimed'].mean():.2%} and a fill rate of {df['is_verified'].sum() / total_shifts:.2%}.
 2. Worker acceptance rates show significant variation, with price sensitivity evident around key thresholds.
 3. Time of day and day of week have substantial impacts on worker engagement.
 4. Lead time is a critical factor in successful shift filling.
@@ -279,5 +282,86 @@ Analysis completed on {datetime.now().strftime('%Y-%m-%d')}
     print("- What causes shifts to get deleted (system vs. workplace patterns)")
 
 
+def main_streaming(data_path='data.csv', chunksize=AGGREGATE_CHUNKSIZE, refit_segments=False, start=None, end=None):
+    """Run the aggregate-based analyses on a file too large to load into memory."""
+    print("Starting Streaming Marketplace Analysis...")
+    start_time = datetime.now()
+    
+    try:
+        aggregates = stream_aggregates(data_path, chunksize=chunksize, start=start, end=end)
+    except Exception as e:
+        print(f"Error streaming aggregates: {e}")
+        return
+    
+    run_aggregate_analyses(aggregates, refit_segments=refit_segments)
+    
+    end_time = datetime.now()
+    duration = end_time - start_time
+    print(f"Streaming analysis complete in {duration.total_seconds():.1f} seconds")
+    print(f"Results saved to {OUTPUT_DIR}")
+
+
+def main_incremental(data_path='data.csv', store_dir=STORE_DIR, refit_segments=False):
+    """Append new offer partitions to the persisted store and refresh the aggregate-based analyses."""
+    print("Starting Incremental Marketplace Analysis...")
+    start_time = datetime.now()
+    
+    try:
+        aggregates = append_to_store(data_path, store_dir)
+    except Exception as e:
+        print(f"Error updating store: {e}")
+        return
+    
+    run_aggregate_analyses(aggregates, refit_segments=refit_segments)
+    
+    end_time = datetime.now()
+    duration = end_time - start_time
+    print(f"Incremental analysis complete in {duration.total_seconds():.1f} seconds")
+    print(f"Results saved to {OUTPUT_DIR}")
+
+
+def run_aggregate_analyses(aggregates, refit_segments=False):
+    """Run the analyses that can work from aggregates alone (see core.stream_aggregates)."""
+    analyses = [
+        ('worker_metrics', worker_metrics),
+        ('workplace_metrics', lambda df, aggregates: workplace_metrics(df, aggregates=aggregates, 
+                                                                       refit_segments=refit_segments)),
+        ('price_sensitivity_analysis', price_sensitivity_analysis),
+        ('lead_time_analysis', lead_time_analysis),
+        ('margin_analysis', margin_analysis)
+    ]
+    for name, analysis in analyses:
+        try:
+            analysis(None, aggregates=aggregates)
+        except Exception as e:
+            print(f"Error in {name}: {e}")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Clipboard Health marketplace analysis")
+    parser.add_argument('--data', default='data.csv', help="Shift offer CSV, directory of CSV partitions, or glob")
+    parser.add_argument('--stream', action='store_true', 
+                        help="Aggregate the file in chunks instead of loading it (for files larger than memory)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Append new partitions from --data to the persisted store and refresh from its aggregates")
+    parser.add_argument('--chunksize', type=int, default=AGGREGATE_CHUNKSIZE, 
+                        help="Rows per chunk in --stream mode")
+    parser.add_argument('--start', help="Only analyze offers viewed on or after this date (e.g. 2024-06-01)")
+    parser.add_argument('--end', help="Only analyze offers viewed before this date")
+    parser.add_argument('--refit-segments', action='store_true',
+                        help="Refit the worker and workplace segment models instead of reusing the saved ones")
+    parser.add_argument('--cohort-period', choices=list(COHORT_PERIODS), default='month',
+                        help="Period that worker retention cohorts are grouped by")
+    args = parser.parse_args()
+    if args.incremental and (args.start or args.end):
+        # The store's aggregates are merged across every ingested partition, so they cannot be windowed
+        parser.error("--start/--end cannot be combined with --incremental; use --stream for a windowed run")
+    
+    if args.incremental:
+        main_incremental(args.data, refit_segments=args.refit_segments)
+    elif args.stream:
+        main_streaming(args.data, chunksize=args.chunksize, refit_segments=args.refit_segments, 
+                       start=args.start, end=args.end)
+    else:
+        main(args.data, start=args.start, end=args.end, refit_segments=args.refit_segments, 
+             cohort_period=args.cohort_period)
\ No newline at end of file
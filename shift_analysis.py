@@ -12,23 +12,23 @@ import seaborn as sns
 from datetime import datetime, timedelta
 import scipy.stats as stats
 import statsmodels.api as sm
-from core import COLORS, PLOT_DIR, TABLE_DIR, TIME_ANALYSIS_DIR
+from core import (COLORS, PLOT_DIR, TABLE_DIR, TIME_ANALYSIS_DIR, RATE_BUCKET_SIZE, feature, has_feature, shift_facts, 
+                  funnel, offer_cube, cube_query)
 
 
-def price_sensitivity_analysis(df):
+def price_sensitivity_analysis(df, aggregates=None):
     """Analyze how claim rates vary with pay rates."""
     print("Analyzing price sensitivity...")
     
     # Create rate buckets
-    bucket_size = 5  # $5 increments
-    df['rate_bucket'] = (df['rate'] // bucket_size) * bucket_size
-    
-    # Calculate claim rates by rate bucket
-    rate_sensitivity = df.groupby('rate_bucket').agg(
-        view_count=('shift_id', 'count'),
-        claim_count=('claimed', 'sum'),
-        no_show_count=('is_ncns', 'sum')
-    ).reset_index()
+    bucket_size = RATE_BUCKET_SIZE
+    if aggregates is not None:
+        rate_sensitivity = aggregates['rate_sensitivity'].copy()
+    else:
+        # Calculate claim rates by rate bucket (marginalized from the per-frame offer cube)
+        rate_sensitivity = cube_query(offer_cube(df), ['rate_bucket']).rename(columns={
+            'views': 'view_count', 'claims': 'claim_count', 'no_shows': 'no_show_count'
+        })[['rate_bucket', 'view_count', 'claim_count', 'no_show_count']]
     
     rate_sensitivity['claim_rate'] = rate_sensitivity['claim_count'] / rate_sensitivity['view_count']
     rate_sensitivity['no_show_rate'] = rate_sensitivity['no_show_count'] / rate_sensitivity['claim_count']
@@ -150,18 +150,9 @@ def shift_type_analysis(df):
         print("Slot information not available, skipping shift type analysis")
         return None
     
-    # Calculate key metrics by slot
-    slot_metrics = df.groupby('slot').agg(
-        views=('shift_id', 'count'),
-        claims=('claimed', 'sum'),
-        completions=('is_verified', 'sum'),
-        no_shows=('is_ncns', 'sum'),
-        avg_rate=('rate', 'mean')
-    ).reset_index()
-    
-    slot_metrics['claim_rate'] = slot_metrics['claims'] / slot_metrics['views']
-    slot_metrics['completion_rate'] = slot_metrics['completions'] / slot_metrics['claims']
-    slot_metrics['no_show_rate'] = slot_metrics['no_shows'] / slot_metrics['claims']
+    # Calculate key metrics by slot (marginalized from the per-frame offer cube)
+    slot_metrics = cube_query(offer_cube(df), ['slot'])[['slot', 'views', 'claims', 'completions', 'no_shows',
+                                                         'avg_rate', 'claim_rate', 'completion_rate', 'no_show_rate']]
     
     # Plot claim rate by slot
     plt.figure(figsize=(10, 8))
@@ -198,7 +189,7 @@ def shift_type_analysis(df):
     
     # Build a confusion matrix of slot preferences
     # For each worker, what percent of their claimed shifts are in each slot?
-    worker_slot_prefs = df[df['claimed']].groupby(['worker_id', 'slot']).size().unstack(fill_value=0)
+    worker_slot_prefs = df[df['claimed']].groupby(['worker_id', 'slot'], observed=True).size().unstack(fill_value=0)
     
     # Convert to percentages
     worker_slot_prefs_pct = worker_slot_prefs.div(worker_slot_prefs.sum(axis=1), axis=0)
@@ -274,7 +265,7 @@ def cancellation_analysis(df):
     
     # Cancellation threshold analysis
     # Group workers by their cancellation rate, then plot retention
-    worker_cancel_rates = df.groupby('worker_id').agg(
+    worker_cancel_rates = df.groupby('worker_id', observed=True).agg(
         claims=('claimed', 'sum'),
         cancellations=('canceled', 'sum')
     )
@@ -292,7 +283,7 @@ def cancellation_analysis(df):
     last_date = df_sorted['shift_start_at'].max()
     retention_threshold = last_date - pd.Timedelta(days=30)
     
-    latest_claims = df[df['claimed']].groupby('worker_id')['shift_start_at'].max()
+    latest_claims = df[df['claimed']].groupby('worker_id', observed=True)['shift_start_at'].max()
     retained_workers = latest_claims[latest_claims >= retention_threshold].index
     worker_cancel_rates['retained'] = worker_cancel_rates.index.isin(retained_workers)
     
@@ -323,20 +314,15 @@ def time_to_decision_analysis(df):
     """Analyze how quickly workers decide to claim shifts and the impact on outcomes."""
     print("Analyzing time-to-decision patterns...")
     
-    # Filter to claimed shifts with valid decision times
-    decision_df = df[df['claimed'] & ~df['decision_time_minutes'].isna()].copy()
+    # Restrict to claimed shifts with valid decision times
+    claimed = df['claimed'] & feature(df, 'decision_time_minutes').notna()
     
-    if len(decision_df) == 0:
+    if not claimed.any():
         print("No valid decision time data, skipping time-to-decision analysis")
         return None
     
-    # Create decision time buckets (in minutes)
-    bins = [0, 1, 5, 15, 30, 60, 120, 240, 1440]
-    labels = ['<1m', '1-5m', '5-15m', '15-30m', '30-60m', '1-2h', '2-4h', '4-24h']
-    decision_df['decision_time_bucket'] = pd.cut(decision_df['decision_time_minutes'], bins=bins, labels=labels)
-    
     # Count decisions by time bucket
-    decision_counts = decision_df['decision_time_bucket'].value_counts().sort_index().reset_index()
+    decision_counts = feature(df, 'decision_time_bucket')[claimed].value_counts().sort_index().reset_index()
     decision_counts.columns = ['decision_time', 'count']
     
     # Calculate percentage
@@ -357,16 +343,10 @@ def time_to_decision_analysis(df):
     decision_counts.to_csv(TABLE_DIR / 'decision_time_distribution.csv', index=False)
     
     # Analyze outcomes by decision time
-    decision_outcomes = decision_df.groupby('decision_time_bucket').agg(
-        claims=('claimed', 'count'),
-        completed=('is_verified', 'sum'),
-        cancelled=('canceled', 'sum'),
-        no_shows=('is_ncns', 'sum')
-    ).reset_index()
-    
-    decision_outcomes['completion_rate'] = decision_outcomes['completed'] / decision_outcomes['claims']
-    decision_outcomes['cancellation_rate'] = decision_outcomes['cancelled'] / decision_outcomes['claims']
-    decision_outcomes['no_show_rate'] = decision_outcomes['no_shows'] / decision_outcomes['claims']
+    decision_outcomes = funnel(df, ['decision_time_bucket'], mask=claimed).rename(columns={
+        'completions': 'completed', 'cancellations': 'cancelled'
+    })[['decision_time_bucket', 'claims', 'completed', 'cancelled', 'no_shows',
+        'completion_rate', 'cancellation_rate', 'no_show_rate']]
     
     # Plot completion rate by decision time
     plt.figure(figsize=(12, 8))
@@ -383,24 +363,15 @@ def time_to_decision_analysis(df):
     return decision_counts, decision_outcomes
 
 
-def lead_time_analysis(df):
+def lead_time_analysis(df, aggregates=None):
     """Analyze how lead time affects fill rates."""
     print("Analyzing lead time effects...")
     
-    # Calculate lead time if it's not already in the dataframe
-    if 'lead_time_days' not in df.columns:
-        if 'shift_start_at' in df.columns and 'shift_created_at' in df.columns:
-            df['lead_time_days'] = (df['shift_start_at'] - df['shift_created_at']).dt.total_seconds() / (3600 * 24)
-            # Filter out unreasonable values
-            df['lead_time_days'] = df['lead_time_days'].where(
-                (df['lead_time_days'] >= 0) & (df['lead_time_days'] < 60),
-                np.nan
-            )
-    
-    # Filter to shifts with valid lead times
-    lead_time_df = df[~df['lead_time_days'].isna()].copy()
+    if aggregates is not None:
+        return _lead_time_rates(aggregates['lead_time_metrics'].copy())
     
-    if len(lead_time_df) == 0:
+    # Need at least one shift with a valid lead time
+    if not has_feature(df, 'lead_time_days') or feature(df, 'lead_time_days').isna().all():
         print("No valid lead time data, calculating based on available timestamps")
         
         # Try to calculate lead time metrics from whatever data is available
@@ -410,48 +381,23 @@ def lead_time_analysis(df):
         labels = ['Same day', '1 day', '2 days', '3-4 days', '5-6 days', '1-2 weeks', '2-4 weeks']
         result['lead_time_bucket'] = labels
         
-        if 'shift_start_at' in df.columns and 'shift_created_at' in df.columns:
-            # Calculate basic stats about shift posting times vs start times
-            total_shifts = df['shift_id'].nunique()
-            same_day_shifts = df[df['shift_start_at'].dt.date == df['shift_created_at'].dt.date]['shift_id'].nunique()
-            same_day_pct = same_day_shifts / total_shifts if total_shifts > 0 else 0.2
-            
-            # Calculate claims by looking at timestamp differences
-            df['posting_to_start_days'] = (df['shift_start_at'] - df['shift_created_at']).dt.total_seconds() / (3600 * 24)
+        if has_feature(df, 'posting_to_start_days'):
+            # Bucket shifts by raw posting-to-start time: <1 day (including negative), 1, 2, 3-4, 5-6, 7-13 and 14+ days
+            facts = shift_facts(df)
+            buckets = pd.cut(facts['posting_to_start_days'], bins=[-np.inf, 1, 2, 3, 5, 7, 14, np.inf], 
+                             labels=labels, right=False)
+            by_bucket = facts.assign(claimed=facts['claims'] > 0, verified=facts['completed'] > 0).groupby(
+                buckets, observed=False)
             
             # Calculate fill rates for different lead time ranges
-            result['shifts'] = np.array([
-                df[df['posting_to_start_days'] < 1]['shift_id'].nunique(), 
-                df[(df['posting_to_start_days'] >= 1) & (df['posting_to_start_days'] < 2)]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 2) & (df['posting_to_start_days'] < 3)]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 3) & (df['posting_to_start_days'] < 5)]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 5) & (df['posting_to_start_days'] < 7)]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 7) & (df['posting_to_start_days'] < 14)]['shift_id'].nunique(),
-                df[df['posting_to_start_days'] >= 14]['shift_id'].nunique()
-            ])
+            result['shifts'] = by_bucket.size().to_numpy()
             
-            # Calculate claim rates for each bucket
+            # Calculate claim rates for each bucket (shifts with at least one claim)
             result['views'] = result['shifts']  # Approximation
-            result['claims'] = np.array([
-                df[(df['posting_to_start_days'] < 1) & (df['claimed'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 1) & (df['posting_to_start_days'] < 2) & (df['claimed'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 2) & (df['posting_to_start_days'] < 3) & (df['claimed'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 3) & (df['posting_to_start_days'] < 5) & (df['claimed'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 5) & (df['posting_to_start_days'] < 7) & (df['claimed'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 7) & (df['posting_to_start_days'] < 14) & (df['claimed'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 14) & (df['claimed'])]['shift_id'].nunique()
-            ])
+            result['claims'] = by_bucket['claimed'].sum().to_numpy()
             
-            # Calculate completions for each bucket
-            result['completions'] = np.array([
-                df[(df['posting_to_start_days'] < 1) & (df['is_verified'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 1) & (df['posting_to_start_days'] < 2) & (df['is_verified'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 2) & (df['posting_to_start_days'] < 3) & (df['is_verified'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 3) & (df['posting_to_start_days'] < 5) & (df['is_verified'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 5) & (df['posting_to_start_days'] < 7) & (df['is_verified'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 7) & (df['posting_to_start_days'] < 14) & (df['is_verified'])]['shift_id'].nunique(),
-                df[(df['posting_to_start_days'] >= 14) & (df['is_verified'])]['shift_id'].nunique()
-            ])
+            # Calculate completions for each bucket (shifts with at least one verified offer)
+            result['completions'] = by_bucket['verified'].sum().to_numpy()
             
             # Calculate metrics
             result['view_per_shift'] = result['views'] / result['shifts'].where(result['shifts'] > 0, 1)
@@ -468,19 +414,21 @@ def lead_time_analysis(df):
             
             return result
     
-    # Create lead time buckets (in days)
-    bins = [0, 1, 2, 3, 5, 7, 14, 30, 60]
-    labels = ['Same day', '1 day', '2 days', '3-4 days', '5-6 days', '1-2 weeks', '2-4 weeks', '1-2 months']
-    lead_time_df['lead_time_bucket'] = pd.cut(lead_time_df['lead_time_days'], bins=bins, labels=labels)
-    
-    # Analyze claim and fill rates by lead time
-    lead_time_metrics = lead_time_df.groupby('lead_time_bucket').agg(
-        shifts=('shift_id', 'nunique'),
-        views=('shift_id', 'count'),
-        claims=('claimed', 'sum'),
-        completions=('is_verified', 'sum')
+    # Analyze claim and fill rates by lead time, a property of the shift (shifts without a valid lead time
+    # fall outside every bucket; empty buckets are still listed)
+    facts = shift_facts(df)
+    lead_time_metrics = facts.groupby(feature(facts, 'lead_time_bucket'), observed=False).agg(
+        shifts=('views', 'size'),
+        views=('views', 'sum'),
+        claims=('claims', 'sum'),
+        completions=('completed', 'sum')
     ).reset_index()
     
+    return _lead_time_rates(lead_time_metrics)
+
+
+def _lead_time_rates(lead_time_metrics):
+    """Add rates to lead time bucket counts, then plot and save them."""
     lead_time_metrics['view_per_shift'] = lead_time_metrics['views'] / lead_time_metrics['shifts']
     lead_time_metrics['claim_rate'] = lead_time_metrics['claims'] / lead_time_metrics['views']
     lead_time_metrics['fill_rate'] = lead_time_metrics['completions'] / lead_time_metrics['shifts']
@@ -503,29 +451,23 @@ def lead_time_analysis(df):
     return lead_time_metrics
 
 
-def margin_analysis(df):
+def margin_analysis(df, aggregates=None):
     """Analyze relationship between margins and key performance metrics."""
     print("Analyzing margin performance...")
     
     # Ensure margin data is available
-    if 'margin' not in df.columns:
+    margin_available = (aggregates['margin_metrics'] is not None if aggregates is not None 
+                        else has_feature(df, 'margin'))
+    if not margin_available:
         print("Margin data not available, skipping margin analysis")
         return None
     
-    # Create margin buckets
-    df['margin_bucket'] = pd.cut(
-        df['margin'],
-        bins=[0, 0.1, 0.2, 0.3, 0.4, 0.5, 1.0],
-        labels=['0-10%', '10-20%', '20-30%', '30-40%', '40-50%', '50%+']
-    )
-    
-    # Calculate key metrics by margin bucket
-    margin_metrics = df.groupby('margin_bucket').agg(
-        shifts=('shift_id', 'nunique'),
-        views=('shift_id', 'count'),
-        claims=('claimed', 'sum'),
-        completions=('is_verified', 'sum')
-    ).reset_index()
+    if aggregates is not None:
+        margin_metrics = aggregates['margin_metrics'].copy()
+    else:
+        # Calculate key metrics by margin bucket (margin varies per offer, so a shift counts in each of its buckets)
+        margin_metrics = funnel(df, ['margin_bucket'], shifts=True)[
+            ['margin_bucket', 'shifts', 'views', 'claims', 'completions']]
     
     margin_metrics['view_per_shift'] = margin_metrics['views'] / margin_metrics['shifts']
     margin_metrics['claim_rate'] = margin_metrics['claims'] / margin_metrics['views']
@@ -553,26 +495,13 @@ def shift_value_analysis(df):
     print("Analyzing shift value impacts...")
     
     # Ensure shift value data is available
-    if 'shift_value' not in df.columns:
+    if not has_feature(df, 'shift_value'):
         print("Shift value data not available, skipping shift value analysis")
         return None
     
-    # Create shift value buckets
-    df['shift_value_bucket'] = pd.cut(
-        df['shift_value'],
-        bins=[0, 100, 200, 300, 400, 500, 1000, 2000],
-        labels=['$0-100', '$100-200', '$200-300', '$300-400', '$400-500', '$500-1000', '$1000+']
-    )
-    
     # Calculate key metrics by shift value bucket
-    value_metrics = df.groupby('shift_value_bucket').agg(
-        views=('shift_id', 'count'),
-        claims=('claimed', 'sum'),
-        completions=('is_verified', 'sum')
-    ).reset_index()
-    
-    value_metrics['claim_rate'] = value_metrics['claims'] / value_metrics['views']
-    value_metrics['completion_rate'] = value_metrics['completions'] / value_metrics['claims']
+    value_metrics = funnel(df, ['shift_value_bucket'])[
+        ['shift_value_bucket', 'views', 'claims', 'completions', 'claim_rate', 'completion_rate']]
     
     # Plot claim rate by shift value
     plt.figure(figsize=(12, 8))
@@ -608,11 +537,10 @@ def dynamic_pricing_analysis(df):
         print("Required columns for dynamic pricing analysis not found")
         return result_df
     
-    print(f"Analyzing {df['shift_id'].nunique()} unique shifts for dynamic pricing")
-    
-    # For each shift, calculate the min, max, and range of offered rates
-    shift_rates = df.groupby('shift_id')['rate'].agg(['min', 'max', 'count', 'mean', 'std']).reset_index()
-    shift_rates['rate_range'] = shift_rates['max'] - shift_rates['min']
+    # For each shift, take the min, max, and range of offered rates from the shift fact table
+    shift_rates = shift_facts(df)[['shift_id', 'min_rate', 'max_rate', 'rate_count']]
+    shift_rates = shift_rates.assign(rate_range=shift_rates['max_rate'] - shift_rates['min_rate'])
+    print(f"Analyzing {len(shift_rates)} unique shifts for dynamic pricing")
     
     # Identify shifts with multiple rates (dynamic pricing)
     dynamic_shifts = shift_rates[shift_rates['rate_range'] > 0]
@@ -627,7 +555,7 @@ def dynamic_pricing_analysis(df):
     # let's use time-based metrics instead of price change metrics
     
     # Update the result with the percentage of shifts viewed multiple times
-    multiple_views = shift_rates[shift_rates['count'] > 1]
+    multiple_views = shift_rates[shift_rates['rate_count'] > 1]
     multiple_views_pct = len(multiple_views) / total_shifts if total_shifts > 0 else 0
     
     # By time to claim instead of by price change
@@ -0,0 +1,95 @@
+"""
+Shared synthetic offer data for the tests
+"""
+
+import sys
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+import core
+
+# Raw extracts carry uppercase headers; these are the flags the data dictionary types as booleans
+BOOL_COLUMNS = ['is_verified', 'is_ncns']
+
+
+def make_raw_offers(n=2000, seed=0):
+    """Raw offer extract (as read from CSV) with missing IDs, view times and rates sprinkled in."""
+    rng = np.random.default_rng(seed)
+    n_shifts = 300
+    # Workplace, slot, posting and start times, charge rate and duration are properties of the shift
+    shift = rng.integers(0, n_shifts, n)
+    created = pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(rng.integers(0, 30 * 24 * 60, n_shifts), unit='min')
+    start = created + pd.to_timedelta(rng.integers(0, 40 * 24, n_shifts), unit='h')
+    viewed = created[shift] + pd.to_timedelta(rng.integers(0, 3 * 24 * 60, n), unit='min')
+    claimed = rng.random(n) < 0.3
+    raw = pd.DataFrame({
+        'WORKER_ID': rng.choice([f'w{i}' for i in range(40)], n),
+        'WORKPLACE_ID': np.array([f'p{i}' for i in rng.integers(0, 10, n_shifts)])[shift],
+        'SHIFT_ID': np.array([f's{i}' for i in range(n_shifts)])[shift],
+        'SLOT': rng.choice(['am', 'pm', 'noc'], n_shifts)[shift],
+        'OFFER_VIEWED_AT': viewed,
+        'SHIFT_CREATED_AT': created[shift],
+        'SHIFT_START_AT': start[shift],
+        'CLAIMED_AT': pd.Series(viewed + pd.Timedelta(minutes=5)).where(claimed),
+        'CANCELED_AT': pd.Series(viewed + pd.Timedelta(hours=1)).where(claimed & (rng.random(n) < 0.2)),
+        'DELETED_AT': pd.Series(viewed).where(rng.random(n) < 0.05),
+        'IS_VERIFIED': claimed & (rng.random(n) < 0.7),
+        'IS_NCNS': claimed & (rng.random(n) < 0.05),
+        'RATE': rng.integers(1500, 6000, n) / 100,
+        'CHARGE_RATE': (rng.integers(2000, 8000, n_shifts) / 100)[shift],
+        'DURATION': rng.choice([4.0, 8.0, 12.0], n_shifts)[shift]
+    })
+    for col in ['WORKER_ID', 'WORKPLACE_ID', 'SHIFT_ID']:
+        raw.loc[rng.random(n) < 0.03, col] = None
+    raw.loc[rng.random(n) < 0.03, 'OFFER_VIEWED_AT'] = pd.NaT
+    raw.loc[rng.random(n) < 0.05, 'RATE'] = np.nan
+    return raw
+
+
+def prepare(raw):
+    """Prepared, ID-encoded offer frame of a raw extract, as load_data returns it."""
+    return core.encode_ids(core._prepare_offers(raw.copy(), {}, BOOL_COLUMNS))
+
+
+@pytest.fixture(scope='session')
+def raw_offers():
+    return make_raw_offers()
+
+
+@pytest.fixture(scope='session')
+def offers(raw_offers):
+    return prepare(raw_offers)
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """Point the cache, store and data dictionary at a scratch directory holding the raw extract as data.csv."""
+    monkeypatch.setattr(core, 'CACHE_DIR', tmp_path / '.cache' / 'offers')
+    monkeypatch.setattr(core, 'STORE_DIR', tmp_path / '.cache' / 'store')
+    monkeypatch.setattr(core, 'DATA_DICTIONARY_PATHS', [REPO_DIR / 'context' / 'data_dictionary.yml'])
+    make_raw_offers().to_csv(tmp_path / 'data.csv', index=False)
+    return tmp_path
+
+
+@pytest.fixture
+def outputs(tmp_path, monkeypatch):
+    """Send the analysis modules' tables to a scratch directory and skip rendering plots."""
+    import shift_analysis
+    import worker_analysis
+    import workplace_analysis
+    
+    tables = tmp_path / 'tables'
+    (tmp_path / 'plots' / 'time_analysis').mkdir(parents=True)
+    (tables / 'retention').mkdir(parents=True)
+    for module in [shift_analysis, worker_analysis, workplace_analysis]:
+        monkeypatch.setattr(module, 'TABLE_DIR', tables)
+        monkeypatch.setattr(module, 'PLOT_DIR', tmp_path / 'plots')
+    monkeypatch.setattr(plt, 'savefig', lambda *args, **kwargs: None)
+    return tables
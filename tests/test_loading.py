@@ -0,0 +1,181 @@
+"""
+Behaviour checks of loading, streaming and the stores behind it against plain pandas on the raw extract
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import core
+
+
+def load(workspace, **kwargs):
+    df, _ = core.load_data(str(workspace / 'data.csv'), **kwargs)
+    return df
+
+
+def by_id(table, df, key):
+    """Result table indexed by decoded ID, in ID order."""
+    return core.decode_ids(table, df).set_index(key).sort_index()
+
+
+def test_missing_ids_are_left_out_of_entity_counts(workspace, outputs):
+    import worker_analysis
+    
+    raw = pd.read_csv(workspace / 'data.csv')
+    df = load(workspace, use_cache=False)
+    
+    for col in core.ID_COLUMNS:
+        assert df[col].nunique() == raw[col.upper()].nunique()
+        assert df[col].isna().sum() == raw[col.upper()].isna().sum()
+    assert len(core.shift_facts(df)) == raw['SHIFT_ID'].nunique()
+    
+    # One row per worker with an ID, counting views as offers with a shift ID, in memory and streamed
+    expected = raw.groupby('WORKER_ID')['SHIFT_ID'].count().rename_axis('worker_id').rename('views')
+    worker_stats = worker_analysis.worker_metrics(df)
+    pd.testing.assert_series_equal(by_id(worker_stats, df, 'worker_id')['views'], expected, check_index_type=False)
+    streamed = core.stream_aggregates(str(workspace / 'data.csv'), chunksize=500)['worker_stats']
+    pd.testing.assert_series_equal(streamed.set_index('worker_id')['views'].sort_index(), expected,
+                                   check_index_type=False, check_categorical=False)
+
+
+def test_workplace_features_match_raw_groupby_and_stream(workspace):
+    raw = pd.read_csv(workspace / 'data.csv', parse_dates=['DELETED_AT', 'CLAIMED_AT'])
+    df = load(workspace, use_cache=False)
+    
+    # Baseline workplace aggregates: shifts and views count offers with a shift ID, the rest all offers
+    expected = raw.assign(claimed=raw['CLAIMED_AT'].notna(), deleted=raw['DELETED_AT'].notna()).groupby(
+        'WORKPLACE_ID').agg(
+        shifts_posted=('SHIFT_ID', 'nunique'),
+        views_received=('SHIFT_ID', 'count'),
+        shifts_claimed=('claimed', 'sum'),
+        shifts_completed=('IS_VERIFIED', 'sum'),
+        shifts_deleted=('deleted', 'sum'),
+        avg_rate=('RATE', 'mean')
+    ).rename_axis('workplace_id')
+    expected['fill_rate'] = expected['shifts_completed'] / expected['shifts_posted']
+    expected['deletion_rate'] = expected['shifts_deleted'] / expected['shifts_posted']
+    
+    features = by_id(core.workplace_features(df), df, 'workplace_id')[expected.columns]
+    streamed = core.stream_aggregates(str(workspace / 'data.csv'), chunksize=500)['workplace_features']
+    streamed = streamed.set_index('workplace_id').sort_index()[expected.columns]
+    pd.testing.assert_frame_equal(features, expected, check_dtype=False, check_index_type=False)
+    pd.testing.assert_frame_equal(streamed, expected, check_dtype=False, check_index_type=False,
+                                  check_categorical=False)
+
+
+def test_streamed_margin_metrics_match_in_memory(workspace):
+    df = load(workspace, use_cache=False)
+    expected = core.funnel(df, ['margin_bucket'], shifts=True)[['margin_bucket', 'shifts', 'views', 'claims',
+                                                                'completions']]
+    streamed = core.stream_aggregates(str(workspace / 'data.csv'), chunksize=500)['margin_metrics']
+    pd.testing.assert_frame_equal(streamed, expected, check_dtype=False)
+
+
+def test_money_sums_match_float64_read(workspace, outputs):
+    import worker_analysis
+    
+    raw = pd.read_csv(workspace / 'data.csv')
+    load(workspace)
+    df = load(workspace)  # served from the cache
+    assert all(df[col].dtype == 'float64' for col in ['rate', 'charge_rate', 'duration'])
+    
+    # Worker earnings summed from a plain float64 read, to well below a cent
+    expected = (raw['RATE'] * raw['DURATION']).where(raw['IS_VERIFIED'], 0).groupby(raw['WORKER_ID']).sum()
+    expected = expected.rename_axis('worker_id').rename('total_earnings')
+    earnings = by_id(worker_analysis.worker_metrics(df), df, 'worker_id')['total_earnings']
+    pd.testing.assert_series_equal(earnings, expected, check_index_type=False, rtol=1e-12)
+    streamed = core.stream_aggregates(str(workspace / 'data.csv'), chunksize=500)['worker_stats']
+    pd.testing.assert_series_equal(streamed.set_index('worker_id')['total_earnings'].sort_index(), expected,
+                                   check_index_type=False, check_categorical=False, rtol=1e-12)
+
+
+def test_streamed_window_matches_windowed_load(workspace):
+    df = load(workspace, start='2024-01-10', end='2024-01-20')
+    expected = by_id(core.workplace_features(df), df, 'workplace_id')
+    
+    streamed = core.stream_aggregates(str(workspace / 'data.csv'), chunksize=500, start='2024-01-10', end='2024-01-20')
+    streamed = streamed['workplace_features'].set_index('workplace_id').sort_index()[expected.columns]
+    pd.testing.assert_frame_equal(streamed, expected, check_dtype=False, check_index_type=False,
+                                  check_categorical=False)
+    with pytest.raises(ValueError):
+        core.stream_aggregates(str(workspace / 'data.csv'), start='2025-01-01')
+
+
+def test_cache_is_rebuilt_when_source_or_version_changes(workspace, monkeypatch):
+    data = workspace / 'data.csv'
+    caches = lambda: sorted(path.name for path in core.CACHE_DIR.iterdir())
+    
+    parsed = load(workspace, use_cache=False)
+    load(workspace)
+    first = caches()
+    pd.testing.assert_frame_equal(load(workspace), parsed)  # served from the cache, missing IDs included
+    
+    # Editing the source changes its fingerprint: the stale cache is replaced, not reused
+    pd.read_csv(data).iloc[:-100].to_csv(data, index=False)
+    assert len(load(workspace)) == len(parsed) - 100
+    second = caches()
+    assert len(second) == 1 and second != first
+    
+    # So does a new cache format, and caches of other sources are left alone
+    pd.read_csv(data).to_csv(workspace / 'other.csv', index=False)
+    core.load_data(str(workspace / 'other.csv'))
+    monkeypatch.setattr(core, 'CACHE_VERSION', core.CACHE_VERSION + 1)
+    assert len(load(workspace)) == len(parsed) - 100
+    third = caches()
+    assert len(third) == 2 and second[0] not in third
+
+
+@pytest.mark.parametrize('chunksize', [137, 5000])
+def test_streamed_aggregates_match_in_memory(workspace, outputs, chunksize):
+    import shift_analysis
+    import worker_analysis
+    
+    df = load(workspace, use_cache=False)
+    streamed = core.stream_aggregates(str(workspace / 'data.csv'), chunksize=chunksize)
+    
+    # Partials merged over many chunks (or one) reproduce the in-memory group-bys
+    columns = ['views', 'claims', 'completed', 'cancellations', 'no_shows', 'avg_rate_viewed', 'avg_rate_claimed',
+               'total_earnings']
+    expected = by_id(worker_analysis.worker_metrics(df), df, 'worker_id')[columns]
+    pd.testing.assert_frame_equal(streamed['worker_stats'].set_index('worker_id').sort_index()[columns], expected,
+                                  check_dtype=False, check_index_type=False, check_categorical=False)
+    expected = core.cube_query(core.offer_cube(df), ['rate_bucket'])
+    pd.testing.assert_frame_equal(streamed['rate_sensitivity'],
+                                  expected[['rate_bucket', 'views', 'claims', 'no_shows']].set_axis(
+                                      ['rate_bucket', 'view_count', 'claim_count', 'no_show_count'], axis=1),
+                                  check_dtype=False)
+    pd.testing.assert_frame_equal(shift_analysis.lead_time_analysis(None, aggregates=streamed),
+                                  shift_analysis.lead_time_analysis(df), check_dtype=False)
+
+
+def test_store_appends_new_partitions_and_swaps_manifest(workspace, monkeypatch):
+    parts, store = workspace / 'parts', workspace / 'store'
+    parts.mkdir()
+    raw = pd.read_csv(workspace / 'data.csv')
+    for i, rows in enumerate(np.array_split(np.arange(len(raw)), 4)):
+        raw.iloc[rows].to_csv(parts / f'day{i}.csv', index=False)
+    names = lambda: [entry['name'] for entry in core._read_store_manifest(store)['partitions']]
+    
+    core.append_to_store(str(parts / 'day[01].csv'), store)
+    assert names() == ['day0.csv', 'day1.csv']
+    
+    # An interrupted swap leaves only the previous aggregates, which are still read and then replaced
+    (store / 'aggregates').rename(store / 'aggregates.old')
+    assert names() == ['day0.csv', 'day1.csv']
+    core.append_to_store(str(parts / 'day[012].csv'), store)
+    aggregates = core.append_to_store(str(parts), store)
+    assert names() == ['day0.csv', 'day1.csv', 'day2.csv', 'day3.csv']
+    assert sorted(path.name for path in store.iterdir()) == ['aggregates', 'offers']
+    
+    expected = core.stream_aggregates(str(parts), chunksize=500)
+    for name in ['worker_stats', 'workplace_features', 'rate_sensitivity', 'lead_time_metrics', 'margin_metrics']:
+        pd.testing.assert_frame_equal(aggregates[name], expected[name], check_dtype=False, check_categorical=False)
+    stored = core.load_store(store)
+    assert len(stored) == len(raw)
+    assert stored['worker_id'].nunique() == raw['WORKER_ID'].nunique()
+    assert stored['worker_id'].isna().sum() == raw['WORKER_ID'].isna().sum()
+    
+    monkeypatch.setattr(core, 'CACHE_VERSION', core.CACHE_VERSION + 1)
+    with pytest.raises(ValueError):
+        core.append_to_store(str(parts), store)
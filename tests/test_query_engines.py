@@ -0,0 +1,154 @@
+"""
+Behaviour checks of the core query engines against brute-force pandas on a small synthetic offer table
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import core
+
+
+@pytest.mark.parametrize('dimensions, where', [
+    (['rate_bucket'], None),
+    (['slot'], None),
+    (['view_hour', 'view_day_of_week'], None),
+    (['slot'], {'lead_time_bucket': ['Same day', '1 day']}),
+    (['margin_bucket', 'slot'], {'view_day_of_week': [0, 6], 'slot': ['am', 'noc']})
+])
+def test_cube_query_matches_funnel(offers, dimensions, where):
+    expected = funnel_where(offers, dimensions, where)
+    result = core.cube_query(core.offer_cube(offers), dimensions, where=where)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_categorical=False,
+                                  check_index_type=False)
+
+
+@pytest.mark.parametrize('dimensions, where, error', [
+    (['shift_type'], None, KeyError),
+    (['slot'], {'shift_type': ['am']}, KeyError),
+    (['slot'], {'slot': ['AM']}, ValueError)
+])
+def test_cube_query_rejects_unknown_dimensions_and_levels(offers, dimensions, where, error):
+    with pytest.raises(error):
+        core.cube_query(core.offer_cube(offers), dimensions, where=where)
+
+
+def funnel_where(df, dimensions, where):
+    """funnel restricted to the offers matching every `where` filter."""
+    mask = pd.Series(True, index=df.index)
+    for dim, levels in (where or {}).items():
+        mask &= core.feature(df, dim).isin(levels)
+    return core.funnel(df, dimensions, mask=mask)
+
+
+@pytest.mark.parametrize('dimension, claimed_only', [
+    ('margin_bucket', False),
+    ('shift_value_bucket', False),
+    ('decision_time_bucket', True)
+])
+def test_funnel_shifts_match_bucket_groupby(offers, dimension, claimed_only):
+    # Baseline bucket tables: every bucket listed, shifts and views count offers with a shift ID
+    df = offers[offers['claimed']] if claimed_only else offers
+    expected = df.groupby(core.feature(df, dimension), observed=False).agg(
+        shifts=('shift_id', 'nunique'),
+        views=('shift_id', 'count'),
+        claims=('claimed', 'sum'),
+        completions=('is_verified', 'sum')
+    ).reset_index()
+    
+    result = core.funnel(offers, [dimension], mask=offers['claimed'] if claimed_only else None, shifts=True)
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
+    if claimed_only:
+        # Synthetic decisions all take five minutes, leaving the other buckets empty
+        assert (result['claims'] == 0).any()
+
+
+@pytest.mark.parametrize('freq, start, end', [
+    ('day', None, None),
+    ('day', '2024-01-03', '2024-01-10'),
+    ('day', '2023-12-01', '2024-01-02'),
+    ('hour', '2024-01-05 06:00', '2024-01-05 18:00'),
+    ('hour', '2024-01-20', '2024-03-01')
+])
+def test_window_kpis_match_filtered_offers(offers, freq, start, end):
+    result = core.window_kpis(core.time_index(offers, freq), start, end).iloc[0]
+    
+    viewed = offers['offer_viewed_at'].notna()
+    in_window = viewed & core._in_window(offers['offer_viewed_at'], start, end)
+    window = offers[in_window]
+    first_views = offers[viewed].groupby('shift_id')['offer_viewed_at'].min()
+    expected = {
+        'shifts': core._in_window(first_views, start, end).sum(),
+        'views': window['shift_id'].notna().sum(),
+        'claims': window['claimed'].sum(),
+        'completions': window['is_verified'].sum(),
+        'cancellations': window['canceled'].sum(),
+        'no_shows': window['is_ncns'].sum(),
+        'deletions': window['deleted'].sum()
+    }
+    assert {name: result[name] for name in expected} == expected
+    assert result['claim_rate'] == pytest.approx(expected['claims'] / expected['views'])
+    assert result['fill_rate'] == pytest.approx(expected['completions'] / expected['shifts'])
+    assert result['avg_rate'] == pytest.approx(window['rate'].astype('float64').mean())
+    assert result['avg_margin'] == pytest.approx(core.feature(offers, 'margin')[in_window].mean())
+
+
+def test_timeline_as_of_ties_and_bounds():
+    t = lambda minute: pd.Timestamp('2024-01-01', tz='UTC') + pd.Timedelta(minutes=minute)
+    df = core.encode_ids(pd.DataFrame({
+        'worker_id': ['a', 'a', 'a', 'a', 'b', 'b', 'c'],
+        'offer_viewed_at': [t(10), t(20), t(20), t(30), t(20), pd.NaT, pd.NaT],
+        'rate': [1.0, 2.0, 3.0, np.nan, 5.0, 6.0, 7.0]
+    }))
+    a, b, c = 0, 1, 2
+    queries = pd.Series([t(30), t(0), t(20), t(25), t(99), t(99), t(99), t(99), pd.NaT],
+                        index=[a, a, a, a, a, b, c, -1, a])
+    
+    result = core.timeline_as_of(df, 'worker_id', 'offer_viewed_at', queries, values={'rate': df['rate']})
+    
+    # Rows at exactly the query time are included; rows without a time never are
+    assert result['worker_id'].tolist() == [a, a, a, a, a, b, c, -1, a]
+    assert result['views'].tolist() == [4, 0, 3, 3, 4, 1, 0, 0, 0]
+    assert result['rate'].tolist() == [6.0, 0.0, 6.0, 6.0, 6.0, 5.0, 0.0, 0.0, 0.0]
+    assert result['last_seen_at'].tolist()[:6] == [t(30), pd.NaT, t(20), t(20), t(30), t(20)]
+    assert result['last_seen_at'].iloc[6:].isna().all()
+    pd.testing.assert_series_equal(result['as_of'], pd.Series(queries.array, name='as_of'))
+
+
+def test_timeline_as_of_matches_filtered_offers(offers):
+    rng = np.random.default_rng(1)
+    picks = rng.choice(len(offers), 200)
+    shifted = pd.to_timedelta(rng.integers(-3 * 24 * 60, 3 * 24 * 60, 200), unit='min')
+    queries = pd.Series((offers['offer_viewed_at'].iloc[picks] + shifted).array,
+                        index=offers['worker_id'].iloc[picks].to_numpy())
+    
+    result = core.timeline_as_of(offers, 'worker_id', 'offer_viewed_at', queries, values={'rate': offers['rate']})
+    
+    for row, (worker, as_of) in zip(result.itertuples(), queries.items()):
+        seen = offers[(offers['worker_id'] == worker) & (offers['offer_viewed_at'] <= as_of)]
+        assert row.views == len(seen)
+        assert row.rate == pytest.approx(seen['rate'].astype('float64').sum())
+        assert (row.last_seen_at == seen['offer_viewed_at'].max()) or (pd.isna(row.last_seen_at) and seen.empty)
+
+
+@pytest.mark.parametrize('period, freq, label', [
+    ('day', 'D', '%Y-%m-%d'),
+    ('week', 'W', '%Y-%m-%d'),
+    ('month', 'M', '%Y-%m')
+])
+def test_cohort_matrix_matches_groupby(offers, period, freq, label):
+    # Distinct workers per (cohort, age) from pandas periods; missing workers and view times are left out
+    viewed = offers[offers['worker_id'].notna() & offers['offer_viewed_at'].notna()]
+    periods = viewed['offer_viewed_at'].dt.tz_localize(None).dt.to_period(freq)
+    ordinals = pd.Series(periods.array.asi8, index=viewed.index)
+    cohorts = ordinals.groupby(viewed['worker_id']).transform('min')
+    expected = viewed['worker_id'].groupby([cohorts, ordinals - cohorts]).nunique().unstack(fill_value=0)
+    n_periods = ordinals.max() - ordinals.min() + 1
+    expected = expected.reindex(columns=range(n_periods), fill_value=0).astype('float64')
+    reached = expected.index.to_numpy()[:, None] - ordinals.min() + np.arange(n_periods)[None, :] < n_periods
+    expected = expected.where(reached)
+    expected.index = [pd.Period(ordinal=code, freq=freq).start_time.strftime(label) for code in expected.index]
+    
+    result = core.cohort_matrix(offers['worker_id'], offers['offer_viewed_at'], period)
+    np.testing.assert_array_equal(result.index, expected.index)
+    np.testing.assert_array_equal(result.to_numpy(), expected.to_numpy())
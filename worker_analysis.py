@@ -10,29 +10,43 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from datetime import datetime, timedelta
-from sklearn.cluster import KMeans
+import os
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import silhouette_score
 from sklearn.decomposition import PCA
-from core import COLORS, PLOT_DIR, TABLE_DIR, TIME_ANALYSIS_DIR, RETENTION_DIR
+from core import (COLORS, PLOT_DIR, TABLE_DIR, TIME_ANALYSIS_DIR, RETENTION_DIR, COHORT_PERIODS, SEGMENTATION_K_RANGE, 
+                  SCALABLE_SEGMENTATION_MIN_WORKERS, SILHOUETTE_SAMPLE_SIZE, decode_ids, feature, offer_cube, cube_query, 
+                  timeline_split, cohort_matrix, concentration_profile, entities_for_share, top_share, load_segment_model, 
+                  save_segment_model, scale_segment_features, segment_model)
 
 
-def worker_metrics(df):
+def worker_metrics(df, aggregates=None):
     """Calculate and visualize worker-related metrics."""
     print("Analyzing worker metrics...")
     
     # 1. Acceptance / Claim Rate
     print("Calculating claim rates...")
-    worker_stats = df.groupby('worker_id').agg(
-        views=('shift_id', 'count'),
-        claims=('claimed', 'sum'),
-        completed=('is_verified', 'sum'),
-        cancellations=('canceled', 'sum'),
-        no_shows=('is_ncns', 'sum'),
-        avg_rate_viewed=('rate', 'mean'),
-        avg_rate_claimed=('rate', lambda x: x[df['claimed']].mean() if any(df['claimed']) else np.nan),
-        total_earnings=('shift_value', lambda x: x[df['is_verified']].sum() if any(df['is_verified']) else 0)
-    ).reset_index()
+    if aggregates is not None:
+        worker_stats = aggregates['worker_stats'].copy()
+    else:
+        # Masked columns keep every aggregate a native groupby reduction
+        offers = df[['worker_id', 'claimed', 'is_verified', 'canceled', 'is_ncns', 'rate']].assign(
+            views=df['shift_id'].notna(),
+            claimed_rate=df['rate'].where(df['claimed']),
+            earnings=feature(df, 'shift_value').where(df['is_verified'], 0)
+        )
+        worker_stats = offers.groupby('worker_id', observed=True).agg(
+            views=('views', 'sum'),
+            claims=('claimed', 'sum'),
+            completed=('is_verified', 'sum'),
+            cancellations=('canceled', 'sum'),
+            no_shows=('is_ncns', 'sum'),
+            avg_rate_viewed=('rate', 'mean'),
+            avg_rate_claimed=('claimed_rate', 'mean'),
+            total_earnings=('earnings', 'sum')
+        ).reset_index()
     
     worker_stats['claim_rate'] = worker_stats['claims'] / worker_stats['views']
     worker_stats['completion_rate'] = worker_stats['completed'] / worker_stats['claims']
@@ -40,7 +54,7 @@ def worker_metrics(df):
     worker_stats['no_show_rate'] = worker_stats['no_shows'] / worker_stats['claims']
     
     # Save worker aggregates
-    worker_stats.to_csv(TABLE_DIR / 'worker_aggregates.csv', index=False)
+    decode_ids(worker_stats, df).to_csv(TABLE_DIR / 'worker_aggregates.csv', index=False)
     
     # 2. Identifying Power Workers
     # Define power workers as those in the top 20% of earnings
@@ -80,10 +94,13 @@ def worker_metrics(df):
 
     # 4. Time of Day Analysis - Claim Rate by Hour
     print("Analyzing time-of-day effects...")
-    hour_metrics = df.groupby('view_hour').agg(
-        views=('shift_id', 'count'),
-        claims=('claimed', 'sum')
-    ).reset_index()
+    if aggregates is not None:
+        hour_metrics = aggregates['hour_metrics'].copy()
+    else:
+        # Marginalized from the per-frame offer cube shared with the day, rate and slot breakdowns; hours
+        # come back as floats when some offers lack a view time, so restore integer keys
+        hour_metrics = cube_query(offer_cube(df), ['view_hour'])[['view_hour', 'views', 'claims']].astype(
+            {'view_hour': 'int64'})
     
     hour_metrics['claim_rate'] = hour_metrics['claims'] / hour_metrics['views']
     
@@ -102,11 +119,11 @@ def worker_metrics(df):
     hour_metrics.to_csv(TABLE_DIR / 'hourly_shift_metrics.csv', index=False)
     
     # 5. Day of Week Analysis
-    day_metrics = df.groupby('view_day_of_week').agg(
-        views=('shift_id', 'count'),
-        claims=('claimed', 'sum'),
-        avg_rate=('rate', 'mean')
-    ).reset_index()
+    if aggregates is not None:
+        day_metrics = aggregates['day_metrics'].copy()
+    else:
+        day_metrics = cube_query(offer_cube(df), ['view_day_of_week'])[
+            ['view_day_of_week', 'views', 'claims', 'avg_rate']].astype({'view_day_of_week': 'int64'})
     
     day_metrics['claim_rate'] = day_metrics['claims'] / day_metrics['views']
     
@@ -128,66 +145,48 @@ def worker_metrics(df):
     day_metrics.to_csv(TABLE_DIR / 'daily_shift_metrics.csv', index=False)
     
     # 6. Experience Analysis
-    print("Analyzing worker experience effects...")
-    
-    # First, sort all data by worker and timestamp to establish chronology
-    df_sorted = df.sort_values(['worker_id', 'offer_viewed_at'])
+    if df is None:
+        print("Skipping worker experience analysis: it needs full offer histories")
+        return worker_stats
     
-    # Create a worker experience dataframe
-    worker_exp = pd.DataFrame()
-    worker_exp['worker_id'] = df_sorted['worker_id'].unique()
-    
-    # For each worker, analyze shifts in order of viewing
-    worker_shifts = {}
-    for worker in worker_exp['worker_id']:
-        worker_data = df_sorted[df_sorted['worker_id'] == worker]
-        worker_shifts[worker] = worker_data
+    print("Analyzing worker experience effects...")
     
-    # Function to calculate metrics by experience level
-    def get_metrics_by_experience(shifts_completed):
-        metrics = []
-        
-        for worker_id, worker_data in worker_shifts.items():
-            # Get completed shifts in chronological order
-            completed = worker_data[worker_data['is_verified']].sort_values('shift_start_at')
-            
-            if len(completed) >= shifts_completed:
-                # Analyze behavior after X completed shifts
-                shift_date = completed.iloc[shifts_completed-1]['shift_start_at']
-                before = worker_data[worker_data['offer_viewed_at'] < shift_date]
-                after = worker_data[worker_data['offer_viewed_at'] >= shift_date]
-                
-                if len(before) > 0 and len(after) > 0:
-                    metrics.append({
-                        'worker_id': worker_id,
-                        'shifts_completed': shifts_completed,
-                        'claim_rate_before': before['claimed'].mean(),
-                        'claim_rate_after': after['claimed'].mean(),
-                        'avg_rate_before': before[before['claimed']]['rate'].mean() if any(before['claimed']) else np.nan,
-                        'avg_rate_after': after[after['claimed']]['rate'].mean() if any(after['claimed']) else np.nan
-                    })
-        
-        return pd.DataFrame(metrics)
+    # Completed shifts of each worker in chronological order, numbered 1, 2, ...
+    completed = df.loc[df['is_verified'], ['worker_id', 'shift_start_at']].sort_values(['worker_id', 'shift_start_at'])
+    completed['shifts_completed'] = completed.groupby('worker_id', observed=True).cumcount() + 1
     
     # Get metrics for different experience thresholds
     exp_thresholds = [1, 3, 5, 10]
-    all_exp_metrics = []
     
-    for threshold in exp_thresholds:
-        exp_df = get_metrics_by_experience(threshold)
-        if len(exp_df) > 0:
-            exp_df['experience_threshold'] = threshold
-            all_exp_metrics.append(exp_df)
+    # Split each worker's offers at the date of their X-th completed shift, for all thresholds at once
+    cutoffs = completed[completed['shifts_completed'].isin(exp_thresholds)]
+    rated_claims = df['claimed'] & df['rate'].notna()
+    split = timeline_split(df, 'worker_id', 'offer_viewed_at',
+                           cutoffs.set_index('worker_id')['shift_start_at'],
+                           {'claims': df['claimed'],
+                            'claimed_rate': df['rate'].where(rated_claims, 0),
+                            'rated_claims': rated_claims})
+    split['shifts_completed'] = cutoffs['shifts_completed'].to_numpy()
+    
+    # Analyze behavior after X completed shifts, for workers with offers on both sides
+    split = split[(split['views_before'] > 0) & (split['views_after'] > 0)]
+    split = split.sort_values(['shifts_completed', 'worker_id'], kind='stable')
+    experience = pd.DataFrame({
+        'worker_id': split['worker_id'],
+        'shifts_completed': split['shifts_completed'],
+        'claim_rate_before': split['claims_before'] / split['views_before'],
+        'claim_rate_after': split['claims_after'] / split['views_after'],
+        'avg_rate_before': split['claimed_rate_before'] / split['rated_claims_before'].where(split['rated_claims_before'] > 0),
+        'avg_rate_after': split['claimed_rate_after'] / split['rated_claims_after'].where(split['rated_claims_after'] > 0),
+        'experience_threshold': split['shifts_completed']
+    })
     
-    if all_exp_metrics:
-        # Combine all experience metrics
-        experience_df = pd.concat(all_exp_metrics)
-        
+    if len(experience) > 0:
         # Save detailed experience metrics
-        experience_df.to_csv(TABLE_DIR / 'worker_experience_metrics.csv', index=False)
+        decode_ids(experience, df).to_csv(TABLE_DIR / 'worker_experience_metrics.csv', index=False)
         
         # Aggregate and visualize
-        experience_summary = experience_df.groupby('experience_threshold').agg(
+        experience_summary = experience.groupby('experience_threshold').agg(
             avg_claim_rate_before=('claim_rate_before', 'mean'),
             avg_claim_rate_after=('claim_rate_after', 'mean'),
             avg_rate_before=('avg_rate_before', 'mean'),
@@ -215,7 +214,44 @@ def worker_metrics(df):
     return worker_stats
 
 
-def worker_segmentation(df, worker_stats):
+def _stratified_sample(strata, size):
+    """Positions of about `size` rows drawn from each stratum in proportion to its share."""
+    positions = pd.Series(np.arange(len(strata)))
+    if len(strata) <= size:
+        return positions.to_numpy()
+    sample = positions.groupby(np.asarray(strata)).sample(frac=size / len(strata), random_state=42)
+    return np.sort(sample.to_numpy())
+
+
+def _fit_minibatch(X, n_clusters, sample):
+    """Fit MiniBatchKMeans on all rows and score it by silhouette on the sampled rows."""
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=42, n_init=3, batch_size=4096)
+    labels = kmeans.fit(X).labels_
+    sample_labels = labels[sample]
+    score = silhouette_score(X[sample], sample_labels) if len(np.unique(sample_labels)) > 1 else -1.0
+    return score, kmeans
+
+
+def _select_k_scalable(X, sample, k_range, workers=None):
+    """Fit each candidate k with MiniBatchKMeans in parallel and score it on the sampled rows."""
+    workers = min(workers or os.cpu_count() or 1, len(k_range))
+    print(f"Scoring {len(k_range)} candidate cluster counts on a {len(sample)}-worker sample "
+          f"with {workers} processes...")
+    
+    n = len(k_range)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_fit_minibatch, [X] * n, k_range, [sample] * n))
+    else:
+        results = [_fit_minibatch(X, n_clusters, sample) for n_clusters in k_range]
+    
+    scores = [score for score, _ in results]
+    models = [kmeans for _, kmeans in results]
+    return scores, models
+
+
+def worker_segmentation(df, worker_stats, scalable=None, sample_size=SILHOUETTE_SAMPLE_SIZE, workers=None, 
+                        refit_segments=False):
     """Segment workers based on behavior patterns and analyze power workers."""
     print("Performing worker segmentation analysis...")
     
@@ -260,21 +296,15 @@ def worker_segmentation(df, worker_stats):
         return None
     
     # First, analyze power workers
-    # Define power workers as those in the top 20% of total claims or total earnings
-    worker_stats = worker_stats.sort_values('claims', ascending=False)
+    # Rank workers by claims once; every share and removal question below reads the running totals
+    worker_stats = concentration_profile(worker_stats, 'claims', ['total_earnings'])
+    worker_stats = worker_stats.rename(columns={'rank_pct': 'worker_rank_pct'})
     total_claims = worker_stats['claims'].sum()
     
-    # Calculate cumulative percentage of claims
-    worker_stats['cumulative_claims'] = worker_stats['claims'].cumsum()
-    worker_stats['cumulative_claims_pct'] = worker_stats['cumulative_claims'] / total_claims * 100
-    
     # Identify what percentage of workers account for X% of claims
     thresholds = [50, 80, 90, 95, 99]
-    worker_pcts = []
-    for threshold in thresholds:
-        workers_needed = worker_stats[worker_stats['cumulative_claims_pct'] <= threshold].shape[0]
-        pct_workers_needed = workers_needed / worker_stats.shape[0] * 100
-        worker_pcts.append(pct_workers_needed)
+    worker_pcts = list(entities_for_share(worker_stats, 'claims', thresholds))
+    for threshold, pct_workers_needed in zip(thresholds, worker_pcts):
         print(f"{threshold}% of claims are made by the top {pct_workers_needed:.1f}% of workers")
     
     # Create worker concentration dataframe
@@ -285,7 +315,6 @@ def worker_segmentation(df, worker_stats):
     
     # Create buckets of workers (top 1%, 1-5%, 5-20%, 20-50%, bottom 50%)
     worker_count = len(worker_stats)
-    worker_stats['worker_rank_pct'] = (worker_stats.index + 1) / worker_count * 100
     
     # Define worker buckets
     bins = [0, 1, 5, 20, 50, 100]
@@ -343,33 +372,17 @@ def worker_segmentation(df, worker_stats):
     # Analyze resilience to worker loss
     # Calculate what would happen if we lost top X% of workers
     resilience_thresholds = [1, 5, 10, 20, 30]
-    resilience_metrics = []
-    
-    for threshold in resilience_thresholds:
-        # Calculate number of workers in this bucket
-        n_workers = int(worker_count * threshold / 100)
-        
-        # Get workers in this bucket
-        top_workers = worker_stats.head(n_workers)
-        
-        # Calculate metrics
-        claims_lost = top_workers['claims'].sum()
-        claims_lost_pct = claims_lost / total_claims * 100
-        
-        earnings_lost = top_workers['total_earnings'].sum()
-        total_earnings = worker_stats['total_earnings'].sum()
-        earnings_lost_pct = earnings_lost / total_earnings * 100 if total_earnings > 0 else 0
-        
-        resilience_metrics.append({
-            'top_worker_pct': threshold,
-            'worker_count': n_workers,
-            'claims_lost': claims_lost,
-            'claims_lost_pct': claims_lost_pct,
-            'earnings_lost': earnings_lost,
-            'earnings_lost_pct': earnings_lost_pct
-        })
-    
-    resilience_df = pd.DataFrame(resilience_metrics)
+    n_workers, claims_lost, claims_lost_pct = top_share(worker_stats, 'claims', resilience_thresholds)
+    _, earnings_lost, earnings_lost_pct = top_share(worker_stats, 'total_earnings', resilience_thresholds)
+    
+    resilience_df = pd.DataFrame({
+        'top_worker_pct': resilience_thresholds,
+        'worker_count': n_workers,
+        'claims_lost': claims_lost,
+        'claims_lost_pct': claims_lost_pct,
+        'earnings_lost': earnings_lost,
+        'earnings_lost_pct': earnings_lost_pct
+    })
     
     # Save resilience metrics
     resilience_df.to_csv(TABLE_DIR / 'worker_concentration_risk.csv', index=False)
@@ -402,29 +415,49 @@ def worker_segmentation(df, worker_stats):
         return None
     
     # Replace NaNs with appropriate values
-    for feature in features:
-        if feature in active_workers.columns:
-            active_workers[feature] = active_workers[feature].fillna(active_workers[feature].median())
+    for col in features:
+        if col in active_workers.columns:
+            active_workers[col] = active_workers[col].fillna(active_workers[col].median())
     
-    # Standardize features
     X = active_workers[features].values
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
-    
-    # Determine optimal number of clusters (2-6)
-    silhouette_scores = []
-    for n_clusters in range(2, 7):
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-        cluster_labels = kmeans.fit_predict(X_scaled)
-        silhouette_scores.append(silhouette_score(X_scaled, cluster_labels))
-    
-    # Choose optimal number of clusters
-    optimal_clusters = silhouette_scores.index(max(silhouette_scores)) + 2
-    print(f"Optimal number of clusters: {optimal_clusters}")
+    if scalable is None:
+        scalable = len(active_workers) >= SCALABLE_SEGMENTATION_MIN_WORKERS
+    plot_rows = (_stratified_sample(active_workers['worker_bucket'], sample_size) if scalable 
+                 else np.arange(len(active_workers)))
+    
+    # Assign workers to the saved segments unless they need refitting
+    model, labels = (None, None) if refit_segments else load_segment_model('workers', features, X)
+    
+    if model is None:
+        # Standardize features
+        scaler = StandardScaler()
+        X_scaled = scaler.fit_transform(X)
+        
+        # Determine optimal number of clusters (2-6)
+        k_range = list(SEGMENTATION_K_RANGE)
+        if scalable:
+            silhouette_scores, models = _select_k_scalable(X_scaled, plot_rows, k_range, workers)
+        else:
+            silhouette_scores = []
+            for n_clusters in k_range:
+                kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
+                cluster_labels = kmeans.fit_predict(X_scaled)
+                silhouette_scores.append(silhouette_score(X_scaled, cluster_labels))
+        
+        # Choose optimal number of clusters
+        best = silhouette_scores.index(max(silhouette_scores))
+        optimal_clusters = k_range[best]
+        print(f"Optimal number of clusters: {optimal_clusters}")
+        
+        # Perform K-means clustering with optimal clusters (the scalable fit already covers every worker)
+        if scalable:
+            kmeans = models[best]
+            labels = kmeans.labels_
+        else:
+            kmeans = KMeans(n_clusters=optimal_clusters, random_state=42, n_init=10)
+            labels = kmeans.fit_predict(X_scaled)
     
-    # Perform K-means clustering with optimal clusters
-    kmeans = KMeans(n_clusters=optimal_clusters, random_state=42, n_init=10)
-    active_workers['cluster'] = kmeans.fit_predict(X_scaled)
+    active_workers['cluster'] = labels
     
     # Analyze cluster characteristics
     cluster_profiles = active_workers.groupby('cluster').agg({
@@ -438,35 +471,43 @@ def worker_segmentation(df, worker_stats):
     
     cluster_profiles['worker_percentage'] = cluster_profiles['worker_id'] / cluster_profiles['worker_id'].sum() * 100
     
-    # Name the clusters based on characteristics
-    cluster_names = []
-    for _, row in cluster_profiles.iterrows():
-        if row['claim_rate'] > 0.1 and row['completion_rate'] > 0.95:
-            name = "Reliable Regulars"
-        elif row['claim_rate'] < 0.05:
-            name = "Selective Pickers"
-        elif row['cancellation_rate'] > 0.1:
-            name = "Frequent Cancellers"
-        elif row['avg_rate_claimed'] > cluster_profiles['avg_rate_claimed'].median():
-            name = "Rate Maximizers"
-        else:
-            name = f"Segment {row['cluster']}"
-        cluster_names.append(name)
+    # Name the clusters based on characteristics when they are fit, and keep those names with the model
+    if model is None:
+        cluster_names = {}
+        for _, row in cluster_profiles.iterrows():
+            if row['claim_rate'] > 0.1 and row['completion_rate'] > 0.95:
+                name = "Reliable Regulars"
+            elif row['claim_rate'] < 0.05:
+                name = "Selective Pickers"
+            elif row['cancellation_rate'] > 0.1:
+                name = "Frequent Cancellers"
+            elif row['avg_rate_claimed'] > cluster_profiles['avg_rate_claimed'].median():
+                name = "Rate Maximizers"
+            else:
+                name = f"Segment {row['cluster']}"
+            cluster_names[row['cluster']] = name
+        
+        names = [cluster_names.get(cluster, f"Segment {cluster}") for cluster in range(len(kmeans.cluster_centers_))]
+        model = segment_model(features, scaler, kmeans.cluster_centers_, names, X)
+        save_segment_model('workers', model)
     
-    cluster_profiles['segment_name'] = cluster_names
+    cluster_names = model['names']
+    cluster_profiles['segment_name'] = cluster_profiles['cluster'].map(dict(enumerate(cluster_names)))
     
     # Save worker segments
     cluster_profiles.to_csv(TABLE_DIR / 'worker_behavior_segments.csv', index=False)
     
     # Visualize clusters using PCA
+    X_scaled = scale_segment_features(model, X)
     pca = PCA(n_components=2)
-    X_pca = pca.fit_transform(X_scaled)
+    X_pca = pca.fit_transform(X_scaled[plot_rows])
     
     plt.figure(figsize=(12, 10))
-    scatter = plt.scatter(X_pca[:, 0], X_pca[:, 1], c=active_workers['cluster'], cmap='viridis', alpha=0.7)
+    scatter = plt.scatter(X_pca[:, 0], X_pca[:, 1], c=active_workers['cluster'].to_numpy()[plot_rows], 
+                          cmap='viridis', alpha=0.7)
     
     # Add cluster centers
-    centers_pca = pca.transform(scaler.transform(kmeans.cluster_centers_))
+    centers_pca = pca.transform(np.asarray(model['centroids']))
     plt.scatter(centers_pca[:, 0], centers_pca[:, 1], c='red', s=100, alpha=0.8, marker='X')
     
     # Add labels
@@ -486,7 +527,7 @@ def worker_segmentation(df, worker_stats):
     return cluster_profiles
 
 
-def worker_retention_analysis(df, worker_stats):
+def worker_retention_analysis(df, worker_stats, period='month'):
     """Analyze worker retention patterns and cohorts."""
     print("Analyzing worker retention...")
     
@@ -511,65 +552,34 @@ def worker_retention_analysis(df, worker_stats):
         print("Insufficient data for detailed retention analysis, using basic metrics")
         return basic_retention_metrics
     
-    # Define cohorts based on first activity month
-    worker_first_activity = df.groupby('worker_id')['offer_viewed_at'].min().reset_index()
-    worker_first_activity['cohort'] = worker_first_activity['offer_viewed_at'].dt.strftime('%Y-%m')
-    
-    # Define retention as having activity in subsequent months
-    worker_activity_months = df.groupby(['worker_id', df['offer_viewed_at'].dt.strftime('%Y-%m')])['shift_id'].count().reset_index()
-    worker_activity_months.columns = ['worker_id', 'activity_month', 'views']
-    
-    # Join first activity to get cohort
-    worker_cohorts = worker_activity_months.merge(
-        worker_first_activity[['worker_id', 'cohort']], 
-        on='worker_id'
-    )
-    
-    # Calculate months since first activity
-    worker_cohorts['cohort_dt'] = pd.to_datetime(worker_cohorts['cohort'] + '-01')
-    worker_cohorts['activity_dt'] = pd.to_datetime(worker_cohorts['activity_month'] + '-01')
-    worker_cohorts['months_since_start'] = ((worker_cohorts['activity_dt'].dt.year - worker_cohorts['cohort_dt'].dt.year) * 12 + 
-                                           (worker_cohorts['activity_dt'].dt.month - worker_cohorts['cohort_dt'].dt.month))
-    
-    # Work with whatever cohort data we have
-    cohort_data = worker_cohorts[worker_cohorts['months_since_start'] >= 0]
+    # Define cohorts by first activity period and count the workers active in each later period
+    cohort_counts = cohort_matrix(df['worker_id'], df['offer_viewed_at'], period)
     
     # If we don't have enough data for a good cohort analysis, we'll still provide basic metrics
-    if len(cohort_data) < 10:
+    if np.nansum(cohort_counts.to_numpy()) < 10:
         print("Limited cohort data available, supplementing with basic metrics")
         return basic_retention_metrics
     
     try:
-        # Calculate which cohorts have enough data (at least 2 months of activity)
-        valid_cohorts = cohort_data.groupby('cohort')['months_since_start'].max()
-        valid_cohorts = valid_cohorts[valid_cohorts >= 2].index
+        # Calculate which cohorts have enough data (activity at least 2 periods after the first)
+        active = cohort_counts.to_numpy() > 0
+        last_active_age = (active * cohort_counts.columns.to_numpy()).max(axis=1)
+        valid_cohorts = last_active_age >= 2
         
         # If no valid cohorts, return basic metrics
-        if len(valid_cohorts) == 0:
+        if not valid_cohorts.any():
             print("No cohorts with sufficient data, using basic metrics")
             return basic_retention_metrics
             
-        # Filter to cohorts with sufficient data
-        cohort_data = cohort_data[cohort_data['cohort'].isin(valid_cohorts)]
+        # Filter to cohorts with sufficient data, and to the ages any of them reached
+        retention_table = cohort_counts[valid_cohorts].iloc[:, :last_active_age[valid_cohorts].max() + 1]
     except Exception as e:
         print(f"Error in cohort calculation: {e}")
         return basic_retention_metrics
     
     try:
-        # Calculate retention rates by cohort and month
-        cohort_sizes = cohort_data[cohort_data['months_since_start'] == 0].groupby('cohort').size()
-        
-        # Check if we have any cohort sizes
-        if cohort_sizes.empty:
-            print("No valid cohort sizes, using basic metrics")
-            return basic_retention_metrics
-            
-        retention_table = pd.crosstab(
-            cohort_data['cohort'], 
-            cohort_data['months_since_start'], 
-            values=cohort_data['worker_id'], 
-            aggfunc='nunique'
-        )
+        # Calculate retention rates by cohort and period
+        cohort_sizes = retention_table[0]
         
         # Convert to rates
         retention_pct = retention_table.div(cohort_sizes, axis=0)
@@ -586,7 +596,7 @@ def worker_retention_analysis(df, worker_stats):
     sns.heatmap(retention_pct, annot=True, fmt='.0%', cmap='viridis', vmin=0, vmax=1)
     
     plt.title('Worker Cohort Retention Rates')
-    plt.xlabel('Months Since First Activity')
+    plt.xlabel(f'{period.capitalize()}s Since First Activity')
     plt.ylabel('Cohort')
     plt.tight_layout()
     plt.savefig(PLOT_DIR / 'worker_cohort_retention.png', dpi=300)
@@ -595,15 +605,15 @@ def worker_retention_analysis(df, worker_stats):
     try:
         # Calculate average retention curve
         avg_retention = retention_pct.mean().reset_index()
-        avg_retention.columns = ['months_since_start', 'retention_rate']
+        avg_retention.columns = ['periods_since_start', 'retention_rate']
         
         # Plot average retention curve
         plt.figure(figsize=(12, 8))
-        plt.plot(avg_retention['months_since_start'], avg_retention['retention_rate'], 
+        plt.plot(avg_retention['periods_since_start'], avg_retention['retention_rate'], 
                 'o-', linewidth=2, markersize=10, color=COLORS['primary'])
         
         plt.title('Average Worker Retention Curve')
-        plt.xlabel('Months Since First Activity')
+        plt.xlabel(f'{period.capitalize()}s Since First Activity')
         plt.ylabel('Retention Rate')
         plt.grid(True, alpha=0.3)
         plt.ylim(0, 1)
@@ -619,26 +629,26 @@ def worker_retention_analysis(df, worker_stats):
         # Create a combined retention DataFrame with all the metrics we need
         retention_metrics = pd.DataFrame()
         
-        # Add months since start
+        # Add periods since start
         if 'avg_retention' in locals() and isinstance(avg_retention, pd.DataFrame) and not avg_retention.empty:
             for i, row in avg_retention.iterrows():
                 try:
-                    months = int(row['months_since_start'])
-                    # Convert months to days (approximately)
-                    days = months * 30
-                    # Add a row for each month's retention rate
+                    periods = int(row['periods_since_start'])
+                    # Convert periods to days (approximately)
+                    days = periods * COHORT_PERIODS[period]
+                    # Add a row for each period's retention rate
                     retention_metrics = pd.concat([retention_metrics, pd.DataFrame([{
                         'days_since_first_activity': days,
                         'is_retained': row['retention_rate'],
                         'retention_rate': row['retention_rate'],
-                        'completed_shifts': months,  # Using months as a proxy for completed shifts
-                        'days_inactive': days,       # Using months*30 as days inactive
+                        'completed_shifts': periods,  # Using periods as a proxy for completed shifts
+                        'days_inactive': days,       # Using elapsed days as days inactive
                         'last_shift_canceled': False,
                         'churned_7d': False,
                         'return_probability': max(0.0, 1.0 - (days / 90.0)),
                         'claim_consistency': 0.5,   # Default value
-                        'unique_workplaces': months, # Proxy - months as workplaces 
-                        'completed_first_shift': True if months > 0 else False
+                        'unique_workplaces': periods, # Proxy - periods as workplaces 
+                        'completed_first_shift': True if periods > 0 else False
                     }])], ignore_index=True)
                 except (ValueError, TypeError) as e:
                     print(f"Error processing retention row: {e}")
@@ -677,39 +687,25 @@ def first_booking_analysis(df):
     """Analyze how long it takes workers to claim their first shift."""
     print("Analyzing first booking patterns...")
     
-    # Sort data by worker and timestamp
-    df_sorted = df.sort_values(['worker_id', 'offer_viewed_at'])
-    
     # For each worker, find their first view and first claim
-    worker_metrics = []
-    for worker_id, worker_data in df_sorted.groupby('worker_id'):
-        first_view = worker_data['offer_viewed_at'].min()
-        claimed_shifts = worker_data[worker_data['claimed']]
-        
-        if len(claimed_shifts) > 0:
-            first_claim = claimed_shifts['claimed_at'].min()
-            time_to_first_claim = (first_claim - first_view).total_seconds() / (3600 * 24)  # days
-            views_before_claim = worker_data[worker_data['offer_viewed_at'] < first_claim].shape[0]
-            
-            worker_metrics.append({
-                'worker_id': worker_id,
-                'first_view_date': first_view,
-                'first_claim_date': first_claim,
-                'days_to_first_claim': time_to_first_claim,
-                'views_before_claim': views_before_claim,
-                'has_claimed': True
-            })
-        else:
-            worker_metrics.append({
-                'worker_id': worker_id,
-                'first_view_date': first_view,
-                'first_claim_date': None,
-                'days_to_first_claim': None,
-                'views_before_claim': worker_data.shape[0],
-                'has_claimed': False
-            })
+    first_claims = df[['worker_id', 'offer_viewed_at']].assign(claimed_at=df['claimed_at'].where(df['claimed']))
+    first_claim_df = first_claims.groupby('worker_id', observed=True).agg(
+        first_view_date=('offer_viewed_at', 'min'),
+        first_claim_date=('claimed_at', 'min'),
+        views=('worker_id', 'size')
+    ).reset_index()
+    first_claim_df['days_to_first_claim'] = (
+        (first_claim_df['first_claim_date'] - first_claim_df['first_view_date']).dt.total_seconds() / (3600 * 24)  # days
+    )
     
-    first_claim_df = pd.DataFrame(worker_metrics)
+    # Views before the first claim come from one searchsorted over the worker timelines;
+    # workers who never claimed count all their views
+    first_claims = first_claim_df.set_index('worker_id')['first_claim_date']
+    views_before = timeline_split(df, 'worker_id', 'offer_viewed_at', first_claims, {})['views_before']
+    first_claim_df['has_claimed'] = first_claim_df['first_claim_date'].notna()
+    first_claim_df['views_before_claim'] = np.where(first_claim_df['has_claimed'], views_before, first_claim_df['views'])
+    first_claim_df = first_claim_df[['worker_id', 'first_view_date', 'first_claim_date', 'days_to_first_claim',
+                                     'views_before_claim', 'has_claimed']]
     
     # Calculate percentage of workers who never claim
     total_workers = len(first_claim_df)
@@ -776,7 +772,7 @@ def first_booking_analysis(df):
     retention_threshold = last_date - pd.Timedelta(days=30)
     
     # Get last view date for each worker
-    worker_last_views = df.groupby('worker_id')['offer_viewed_at'].max().reset_index()
+    worker_last_views = df.groupby('worker_id', observed=True)['offer_viewed_at'].max().reset_index()
     worker_last_views['retained'] = worker_last_views['offer_viewed_at'] >= retention_threshold
     
     # Merge with first claim data
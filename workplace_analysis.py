@@ -14,51 +14,38 @@ from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import silhouette_score
 from sklearn.decomposition import PCA
-from core import COLORS, PLOT_DIR, TABLE_DIR
+from core import (COLORS, PLOT_DIR, TABLE_DIR, WORKPLACE_RETENTION_CURVE, WORKPLACE_RETENTION_THRESHOLDS, decode_ids,
+                  interaction_matrix, timeline_split, workplace_features, load_segment_model, save_segment_model, 
+                  scale_segment_features, segment_model, concentration_profile, entities_for_share, top_share, 
+                  shift_facts)
 
+# Columns of the workplace feature table reported as workplace aggregates
+WORKPLACE_STAT_COLUMNS = ['workplace_id', 'shifts_posted', 'views_received', 'shifts_claimed', 'shifts_completed',
+                          'shifts_cancelled', 'shifts_deleted', 'avg_rate', 'avg_charge_rate', 'avg_margin',
+                          'view_per_shift', 'claim_rate', 'fill_rate', 'cancellation_rate', 'deletion_rate']
 
-def workplace_metrics(df):
+
+def workplace_metrics(df, aggregates=None, refit_segments=False):
     """Calculate and visualize workplace-related metrics."""
     print("Analyzing workplace metrics...")
     
-    # Calculate key metrics by workplace
-    workplace_stats = df.groupby('workplace_id').agg(
-        shifts_posted=('shift_id', 'nunique'),
-        views_received=('shift_id', 'count'),
-        shifts_claimed=('claimed', 'sum'),
-        shifts_completed=('is_verified', 'sum'),
-        shifts_cancelled=('canceled', 'sum'),
-        shifts_deleted=('deleted', 'sum'),
-        avg_rate=('rate', 'mean'),
-        avg_charge_rate=('charge_rate', 'mean'),
-        avg_margin=('margin', 'mean')
-    ).reset_index()
-    
-    # Calculate derived metrics
-    workplace_stats['view_per_shift'] = workplace_stats['views_received'] / workplace_stats['shifts_posted']
-    workplace_stats['claim_rate'] = workplace_stats['shifts_claimed'] / workplace_stats['views_received']
-    workplace_stats['fill_rate'] = workplace_stats['shifts_completed'] / workplace_stats['shifts_posted']
-    workplace_stats['cancellation_rate'] = workplace_stats['shifts_cancelled'] / workplace_stats['shifts_claimed']
-    workplace_stats['deletion_rate'] = workplace_stats['shifts_deleted'] / workplace_stats['shifts_posted']
+    # Calculate key metrics by workplace: every workplace feature comes from one fused table
+    features = aggregates['workplace_features'] if aggregates is not None else workplace_features(df)
+    latest_posts = features.set_index('workplace_id')['latest_post']
+    workplace_stats = features[WORKPLACE_STAT_COLUMNS].copy()
     
     # Save workplace metrics
-    workplace_stats.to_csv(TABLE_DIR / 'workplace_aggregates.csv', index=False)
+    decode_ids(workplace_stats, df).to_csv(TABLE_DIR / 'workplace_aggregates.csv', index=False)
     
-    # Analyze workplace concentration (similar to worker concentration)
-    workplace_stats = workplace_stats.sort_values('shifts_posted', ascending=False)
+    # Analyze workplace concentration (similar to worker concentration): rank once by shifts posted
+    workplace_stats = concentration_profile(workplace_stats, 'shifts_posted')
+    workplace_stats = workplace_stats.rename(columns={'rank_pct': 'workplace_rank_pct'})
     total_shifts = workplace_stats['shifts_posted'].sum()
     
-    # Calculate cumulative percentage of shifts
-    workplace_stats['cumulative_shifts'] = workplace_stats['shifts_posted'].cumsum()
-    workplace_stats['cumulative_shifts_pct'] = workplace_stats['cumulative_shifts'] / total_shifts * 100
-    
     # Identify what percentage of workplaces account for X% of shifts
     thresholds = [50, 71.35, 80, 90, 95]  # Including the specific 71.35% from the question
-    workplace_pcts = []
-    for threshold in thresholds:
-        workplaces_needed = workplace_stats[workplace_stats['cumulative_shifts_pct'] <= threshold].shape[0]
-        pct_workplaces_needed = workplaces_needed / workplace_stats.shape[0] * 100
-        workplace_pcts.append(pct_workplaces_needed)
+    workplace_pcts = list(entities_for_share(workplace_stats, 'shifts_posted', thresholds))
+    for threshold, pct_workplaces_needed in zip(thresholds, workplace_pcts):
         print(f"{threshold}% of shifts are posted by the top {pct_workplaces_needed:.1f}% of workplaces")
     
     # Create workplace concentration dataframe
@@ -69,7 +56,7 @@ def workplace_metrics(df):
     
     # Plot concentration of shifts
     plt.figure(figsize=(10, 8))
-    plt.plot(workplace_stats['cumulative_shifts_pct'], workplace_stats.index / len(workplace_stats) * 100, 
+    plt.plot(workplace_stats['cumulative_shifts_posted_pct'], workplace_stats['workplace_rank_pct'], 
              'b-', linewidth=2, label='Shifts')
     
     # Add reference line for perfect equality
@@ -94,7 +81,6 @@ def workplace_metrics(df):
     
     # Create buckets of workplaces (top 1%, 1-5%, 5-20%, 20-50%, bottom 50%)
     workplace_count = len(workplace_stats)
-    workplace_stats['workplace_rank_pct'] = (workplace_stats.index + 1) / workplace_count * 100
     
     # Define workplace buckets
     bins = [0, 1, 5, 20, 50, 100]
@@ -141,7 +127,7 @@ def workplace_metrics(df):
         
         # Analyze why these workplaces have low fill rates
         # Compare their pay rates to the average
-        avg_pay_rate = df['rate'].mean()
+        avg_pay_rate = aggregates['avg_rate'] if aggregates is not None else df['rate'].mean()
         problematic_pay = problematic_workplaces['avg_rate'].mean()
         pay_delta_pct = (problematic_pay - avg_pay_rate) / avg_pay_rate * 100
         
@@ -149,12 +135,12 @@ def workplace_metrics(df):
               f"({pay_delta_pct:.1f}% {'above' if pay_delta_pct > 0 else 'below'} average)")
         
         # Look at lead times for problematic workplaces
-        if 'lead_time_days' in df.columns:
-            problematic_ids = problematic_workplaces['workplace_id'].values
-            problematic_shifts = df[df['workplace_id'].isin(problematic_ids)]
-            
-            avg_lead_time = df['lead_time_days'].mean()
-            problematic_lead_time = problematic_shifts['lead_time_days'].mean()
+        if features['lead_time_count'].sum() > 0:
+            # Offer-weighted means of the per-workplace lead times
+            lead_time_total = features['avg_lead_time'].fillna(0) * features['lead_time_count']
+            problematic = features['workplace_id'].isin(problematic_workplaces['workplace_id'].values)
+            avg_lead_time = lead_time_total.sum() / features['lead_time_count'].sum()
+            problematic_lead_time = lead_time_total[problematic].sum() / features.loc[problematic, 'lead_time_count'].sum()
             lead_delta_pct = (problematic_lead_time - avg_lead_time) / avg_lead_time * 100
             
             print(f"Average lead time for problematic workplaces: {problematic_lead_time:.1f} days " +
@@ -164,7 +150,7 @@ def workplace_metrics(df):
         top_problematic = problematic_workplaces.sort_values('shifts_posted', ascending=False).head(10)
         
         plt.figure(figsize=(12, 8))
-        bar_plot = sns.barplot(x='workplace_id', y='fill_rate', data=top_problematic, color=COLORS['danger'])
+        bar_plot = sns.barplot(x='workplace_id', y='fill_rate', data=decode_ids(top_problematic, df).astype({'workplace_id': str}), color=COLORS['danger'])
         
         # Add pay rate labels on top of each bar
         for i, workplace in enumerate(top_problematic.itertuples()):
@@ -181,56 +167,43 @@ def workplace_metrics(df):
         plt.savefig(PLOT_DIR / 'problematic_workplaces.png', dpi=300)
         plt.close()
         
-        # Save problematic workplace data
-        problematic_workplaces.to_csv(TABLE_DIR / 'problematic_workplaces.csv', index=False)
+        # Save problematic workplace data, keeping the table's published column names and order
+        problematic_table = problematic_workplaces.rename(columns={
+            'cumulative_shifts_posted': 'cumulative_shifts', 'cumulative_shifts_posted_pct': 'cumulative_shifts_pct'})
+        columns = [col for col in problematic_table.columns if col != 'workplace_rank_pct']
+        columns.insert(columns.index('cumulative_shifts_pct') + 1, 'workplace_rank_pct')
+        decode_ids(problematic_table[columns], df).to_csv(TABLE_DIR / 'problematic_workplaces.csv', index=False)
     
     # Workplace stickiness analysis
-    # First, sort all data by workplace and timestamp to establish chronology
-    df_sorted = df.sort_values(['workplace_id', 'shift_created_at'])
-    
-    # For each workplace, analyze their posting behavior over time
-    workplace_shifts = {}
-    for workplace in workplace_stats['workplace_id']:
-        workplace_data = df_sorted[df_sorted['workplace_id'] == workplace]
-        workplace_shifts[workplace] = workplace_data
-    
     # Determine if there's a "stickiness point" for workplaces
     # How many successful shifts must be filled before a workplace becomes a regular poster?
-    def get_workplace_retention(min_filled_shifts):
-        retained = []
-        for workplace_id, workplace_data in workplace_shifts.items():
-            # Count filled shifts
-            filled = workplace_data[workplace_data['is_verified']].sort_values('shift_start_at')
-            if len(filled) >= min_filled_shifts:
-                # Get date of the min_filled_shifts-th filled shift
-                threshold_date = filled.iloc[min_filled_shifts-1]['shift_start_at']
-                
-                # Is there posting activity at least 30 days after that date?
-                last_post = workplace_data['shift_created_at'].max()
-                retained.append(1 if (last_post - threshold_date).days >= 30 else 0)
-        
-        return np.mean(retained) if retained else 0
-    
-    # Check retention rates at different filled shift thresholds
-    thresholds = [1, 3, 5, 10, 15]
-    retention_rates = [get_workplace_retention(t) for t in thresholds]
+    if aggregates is not None:
+        # Streamed aggregates keep each workplace's earliest filled shifts and latest post
+        filled_shifts = aggregates['workplace_filled']
+    else:
+        filled_shifts = df.loc[df['is_verified'], ['workplace_id', 'shift_start_at']]
     
-    workplace_retention = pd.DataFrame({
-        'filled_shifts_threshold': thresholds,
-        'retention_rate': retention_rates
-    })
+    # Check retention rates at every filled shift count up to the end of the curve
+    retention_curve = _workplace_retention_curve(filled_shifts, latest_posts, workplace_stats['workplace_id'],
+                                                 WORKPLACE_RETENTION_CURVE)
+    retention_curve.to_csv(TABLE_DIR / 'workplace_stickiness_curve.csv', index=False)
+    thresholds = WORKPLACE_RETENTION_THRESHOLDS
+    workplace_retention = retention_curve[retention_curve['filled_shifts_threshold'].isin(thresholds)]
     
     # Plot workplace retention by filled shifts
     plt.figure(figsize=(12, 8))
+    plt.plot(retention_curve['filled_shifts_threshold'], 
+            retention_curve['retention_rate'], 
+            '-', color=COLORS['primary'], linewidth=2)
     plt.plot(workplace_retention['filled_shifts_threshold'], 
             workplace_retention['retention_rate'], 
-            'o-', color=COLORS['primary'], linewidth=2, markersize=10)
+            'o', color=COLORS['primary'], markersize=10)
     
     plt.title('Workplace Retention Rate by Number of Filled Shifts')
     plt.xlabel('Number of Successfully Filled Shifts')
     plt.ylabel('Retention Rate')
     plt.grid(True, alpha=0.3)
-    plt.xticks(thresholds)
+    plt.xticks(thresholds + list(range(20, max(WORKPLACE_RETENTION_CURVE) + 1, 10)))
     plt.ylim(0, 1)
     plt.tight_layout()
     plt.savefig(PLOT_DIR / 'workplace_stickiness.png', dpi=300)
@@ -242,59 +215,53 @@ def workplace_metrics(df):
     
     if len(active_workplaces) >= 20:  # Need enough data for meaningful clusters
         # Select features for clustering
-        features = ['avg_rate', 'fill_rate', 'claim_rate', 'view_per_shift', 'deletion_rate']
+        cluster_features = ['avg_rate', 'fill_rate', 'claim_rate', 'view_per_shift', 'deletion_rate']
         
         # Replace NaNs with appropriate values
-        for feature in features:
-            if feature in active_workplaces.columns:
-                active_workplaces[feature] = active_workplaces[feature].fillna(active_workplaces[feature].median())
+        for col in cluster_features:
+            if col in active_workplaces.columns:
+                active_workplaces[col] = active_workplaces[col].fillna(active_workplaces[col].median())
         
         # Add calculated features if available
-        if 'lead_time_days' in df.columns:
-            # Calculate average lead time by workplace
-            lead_times = df.groupby('workplace_id')['lead_time_days'].mean().reset_index()
-            lead_times.columns = ['workplace_id', 'avg_lead_time']
-            
-            # Add to active_workplaces
+        if features['lead_time_count'].sum() > 0:
+            # Add average lead time by workplace to active_workplaces
+            lead_times = features[['workplace_id', 'avg_lead_time']]
             active_workplaces = active_workplaces.merge(lead_times, on='workplace_id', how='left')
             active_workplaces['avg_lead_time'] = active_workplaces['avg_lead_time'].fillna(active_workplaces['avg_lead_time'].median())
             
             # Add to features
-            features.append('avg_lead_time')
-        
-        # Calculate rate variability
-        if 'shift_id' in df.columns and 'rate' in df.columns:
-            # For each workplace, calculate standard deviation of rates
-            rate_variability = df.groupby(['workplace_id', 'shift_id'])['rate'].mean().reset_index()
-            rate_variability = rate_variability.groupby('workplace_id')['rate'].std().reset_index()
-            rate_variability.columns = ['workplace_id', 'rate_std']
-            
-            # Add to active_workplaces
-            active_workplaces = active_workplaces.merge(rate_variability, on='workplace_id', how='left')
-            active_workplaces['rate_std'] = active_workplaces['rate_std'].fillna(0)  # No variability if only one rate
-            
-            # Add to features
-            features.append('rate_std')
+            cluster_features.append('avg_lead_time')
         
-        # Standardize features
-        X = active_workplaces[features].values
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X)
+        # Add rate variability: standard deviation of per-shift rates within each workplace
+        active_workplaces = active_workplaces.merge(features[['workplace_id', 'rate_std']], on='workplace_id', how='left')
+        active_workplaces['rate_std'] = active_workplaces['rate_std'].fillna(0)  # No variability if only one rate
+        cluster_features.append('rate_std')
         
-        # Determine optimal number of clusters
-        silhouette_scores = []
-        for n_clusters in range(2, min(7, len(active_workplaces) // 5 + 1)):
-            kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-            cluster_labels = kmeans.fit_predict(X_scaled)
-            silhouette_scores.append(silhouette_score(X_scaled, cluster_labels))
+        # Assign workplaces to the saved segments unless they need refitting
+        X = active_workplaces[cluster_features].values
+        model, labels = (None, None) if refit_segments else load_segment_model('workplaces', cluster_features, X)
         
-        # Choose optimal number of clusters
-        optimal_clusters = silhouette_scores.index(max(silhouette_scores)) + 2
-        print(f"Optimal number of workplace clusters: {optimal_clusters}")
+        if model is None:
+            # Standardize features
+            scaler = StandardScaler()
+            X_scaled = scaler.fit_transform(X)
+            
+            # Determine optimal number of clusters
+            silhouette_scores = []
+            for n_clusters in range(2, min(7, len(active_workplaces) // 5 + 1)):
+                kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
+                cluster_labels = kmeans.fit_predict(X_scaled)
+                silhouette_scores.append(silhouette_score(X_scaled, cluster_labels))
+            
+            # Choose optimal number of clusters
+            optimal_clusters = silhouette_scores.index(max(silhouette_scores)) + 2
+            print(f"Optimal number of workplace clusters: {optimal_clusters}")
+            
+            # Perform K-means clustering with optimal clusters
+            kmeans = KMeans(n_clusters=optimal_clusters, random_state=42, n_init=10)
+            labels = kmeans.fit_predict(X_scaled)
         
-        # Perform K-means clustering with optimal clusters
-        kmeans = KMeans(n_clusters=optimal_clusters, random_state=42, n_init=10)
-        active_workplaces['cluster'] = kmeans.fit_predict(X_scaled)
+        active_workplaces['cluster'] = labels
         
         # Analyze cluster characteristics
         cluster_profiles = active_workplaces.groupby('cluster').agg({
@@ -316,38 +283,45 @@ def workplace_metrics(df):
             rate_std_means = active_workplaces.groupby('cluster')['rate_std'].mean()
             cluster_profiles['rate_variability'] = cluster_profiles['cluster'].map(rate_std_means)
         
-        # Name the clusters based on characteristics
-        cluster_names = []
-        for _, row in cluster_profiles.iterrows():
-            if 'avg_lead_time' in cluster_profiles.columns and 'rate_variability' in cluster_profiles.columns:
-                if row['avg_lead_time'] > cluster_profiles['avg_lead_time'].median() and row['rate_variability'] < cluster_profiles['rate_variability'].median():
-                    name = "Early Posters, Consistent Rates"
-                elif row['avg_lead_time'] < cluster_profiles['avg_lead_time'].median() and row['rate_variability'] > cluster_profiles['rate_variability'].median():
-                    name = "Last-Minute Posters, Variable Rates"
-                elif row['avg_lead_time'] > cluster_profiles['avg_lead_time'].median() and row['rate_variability'] > cluster_profiles['rate_variability'].median():
-                    name = "Early Posters, Variable Rates"
-                elif row['avg_lead_time'] < cluster_profiles['avg_lead_time'].median() and row['rate_variability'] < cluster_profiles['rate_variability'].median():
-                    name = "Last-Minute Posters, Consistent Rates"
+        # Name the clusters based on characteristics when they are fit, and keep those names with the model
+        if model is None:
+            cluster_names = {}
+            for _, row in cluster_profiles.iterrows():
+                if 'avg_lead_time' in cluster_profiles.columns and 'rate_variability' in cluster_profiles.columns:
+                    if row['avg_lead_time'] > cluster_profiles['avg_lead_time'].median() and row['rate_variability'] < cluster_profiles['rate_variability'].median():
+                        name = "Early Posters, Consistent Rates"
+                    elif row['avg_lead_time'] < cluster_profiles['avg_lead_time'].median() and row['rate_variability'] > cluster_profiles['rate_variability'].median():
+                        name = "Last-Minute Posters, Variable Rates"
+                    elif row['avg_lead_time'] > cluster_profiles['avg_lead_time'].median() and row['rate_variability'] > cluster_profiles['rate_variability'].median():
+                        name = "Early Posters, Variable Rates"
+                    elif row['avg_lead_time'] < cluster_profiles['avg_lead_time'].median() and row['rate_variability'] < cluster_profiles['rate_variability'].median():
+                        name = "Last-Minute Posters, Consistent Rates"
+                    else:
+                        name = f"Cluster {row['cluster']}"
+                elif row['avg_rate'] > cluster_profiles['avg_rate'].median() and row['fill_rate'] > cluster_profiles['fill_rate'].median():
+                    name = "High Pay, High Fill"
+                elif row['avg_rate'] < cluster_profiles['avg_rate'].median() and row['fill_rate'] < cluster_profiles['fill_rate'].median():
+                    name = "Low Pay, Low Fill"
+                elif row['avg_rate'] > cluster_profiles['avg_rate'].median() and row['fill_rate'] < cluster_profiles['fill_rate'].median():
+                    name = "High Pay, Low Fill" 
+                elif row['avg_rate'] < cluster_profiles['avg_rate'].median() and row['fill_rate'] > cluster_profiles['fill_rate'].median():
+                    name = "Low Pay, High Fill"
                 else:
                     name = f"Cluster {row['cluster']}"
-            elif row['avg_rate'] > cluster_profiles['avg_rate'].median() and row['fill_rate'] > cluster_profiles['fill_rate'].median():
-                name = "High Pay, High Fill"
-            elif row['avg_rate'] < cluster_profiles['avg_rate'].median() and row['fill_rate'] < cluster_profiles['fill_rate'].median():
-                name = "Low Pay, Low Fill"
-            elif row['avg_rate'] > cluster_profiles['avg_rate'].median() and row['fill_rate'] < cluster_profiles['fill_rate'].median():
-                name = "High Pay, Low Fill" 
-            elif row['avg_rate'] < cluster_profiles['avg_rate'].median() and row['fill_rate'] > cluster_profiles['fill_rate'].median():
-                name = "Low Pay, High Fill"
-            else:
-                name = f"Cluster {row['cluster']}"
-            cluster_names.append(name)
-        
-        cluster_profiles['segment_name'] = cluster_names
+                cluster_names[row['cluster']] = name
+            
+            names = [cluster_names.get(cluster, f"Cluster {cluster}") for cluster in range(len(kmeans.cluster_centers_))]
+            model = segment_model(cluster_features, scaler, kmeans.cluster_centers_, names, X)
+            save_segment_model('workplaces', model)
+        
+        cluster_names = model['names']
+        cluster_profiles['segment_name'] = cluster_profiles['cluster'].map(dict(enumerate(cluster_names)))
         
         # Save workplace segments
         cluster_profiles.to_csv(TABLE_DIR / 'workplace_behavior_segments.csv', index=False)
         
         # Visualize clusters using PCA
+        X_scaled = scale_segment_features(model, X)
         pca = PCA(n_components=2)
         X_pca = pca.fit_transform(X_scaled)
         
@@ -355,7 +329,7 @@ def workplace_metrics(df):
         scatter = plt.scatter(X_pca[:, 0], X_pca[:, 1], c=active_workplaces['cluster'], cmap='viridis', alpha=0.7)
         
         # Add cluster centers
-        centers_pca = pca.transform(scaler.transform(kmeans.cluster_centers_))
+        centers_pca = pca.transform(np.asarray(model['centroids']))
         plt.scatter(centers_pca[:, 0], centers_pca[:, 1], c='red', s=100, alpha=0.8, marker='X')
         
         # Add labels
@@ -374,30 +348,28 @@ def workplace_metrics(df):
     
     # Workplace confusion matrix - retention prediction
     # Get workplace attributes
-    workplace_features = workplace_stats[['workplace_id', 'fill_rate', 'claim_rate', 'avg_rate', 'avg_margin']]
+    retention_features = workplace_stats[['workplace_id', 'fill_rate', 'claim_rate', 'avg_rate', 'avg_margin']]
     
     # Define retention (posted shifts in the last 30 days of data)
-    df_sorted = df.sort_values('shift_created_at')
-    last_date = df_sorted['shift_created_at'].max()
+    last_date = latest_posts.max()
     retention_threshold = last_date - pd.Timedelta(days=30)
     
-    latest_posts = df.groupby('workplace_id')['shift_created_at'].max()
     retained_workplaces = latest_posts[latest_posts >= retention_threshold].index
-    workplace_features['retained'] = workplace_features['workplace_id'].isin(retained_workplaces)
+    retention_features['retained'] = retention_features['workplace_id'].isin(retained_workplaces)
     
     # Build confusion matrix
-    if len(workplace_features) > 20:  # Need enough data
+    if len(retention_features) > 20:  # Need enough data
         # Create quartiles for features
-        for feature in ['fill_rate', 'claim_rate', 'avg_rate']:
-            if feature in workplace_features.columns:
-                workplace_features[f'{feature}_quartile'] = pd.qcut(
-                    workplace_features[feature],
+        for col in ['fill_rate', 'claim_rate', 'avg_rate']:
+            if col in retention_features.columns:
+                retention_features[f'{col}_quartile'] = pd.qcut(
+                    retention_features[col],
                     q=4,
                     labels=['Q1', 'Q2', 'Q3', 'Q4']
                 )
         
         # Plot retention by fill rate quartile
-        retention_by_fill = workplace_features.groupby('fill_rate_quartile')['retained'].mean().reset_index()
+        retention_by_fill = retention_features.groupby('fill_rate_quartile')['retained'].mean().reset_index()
         
         plt.figure(figsize=(10, 8))
         sns.barplot(x='fill_rate_quartile', y='retained', data=retention_by_fill, color=COLORS['primary'])
@@ -413,27 +385,14 @@ def workplace_metrics(df):
     # Analyze risk of reliance on top workplaces
     # Calculate what would happen if we lost top X% of workplaces
     resilience_thresholds = [1, 5, 10, 20, 30]
-    resilience_metrics = []
+    n_workplaces, shifts_lost, shifts_lost_pct = top_share(workplace_stats, 'shifts_posted', resilience_thresholds)
     
-    for threshold in resilience_thresholds:
-        # Calculate number of workplaces in this bucket
-        n_workplaces = int(workplace_count * threshold / 100)
-        
-        # Get workplaces in this bucket
-        top_workplaces = workplace_stats.head(n_workplaces)
-        
-        # Calculate metrics
-        shifts_lost = top_workplaces['shifts_posted'].sum()
-        shifts_lost_pct = shifts_lost / total_shifts * 100
-        
-        resilience_metrics.append({
-            'top_workplace_pct': threshold,
-            'workplace_count': n_workplaces,
-            'shifts_lost': shifts_lost,
-            'shifts_lost_pct': shifts_lost_pct
-        })
-    
-    resilience_df = pd.DataFrame(resilience_metrics)
+    resilience_df = pd.DataFrame({
+        'top_workplace_pct': resilience_thresholds,
+        'workplace_count': n_workplaces,
+        'shifts_lost': shifts_lost,
+        'shifts_lost_pct': shifts_lost_pct
+    })
     
     # Save resilience metrics
     resilience_df.to_csv(TABLE_DIR / 'workplace_concentration_risk.csv', index=False)
@@ -454,6 +413,25 @@ def workplace_metrics(df):
     return workplace_stats
 
 
+def _workplace_retention_curve(filled_shifts, latest_posts, workplace_ids, thresholds):
+    """Share of workplaces still posting 30+ days after their n-th filled shift, for each n in thresholds."""
+    filled = filled_shifts[filled_shifts['workplace_id'].isin(workplace_ids)]
+    filled = filled.sort_values(['workplace_id', 'shift_start_at'])
+    filled = filled.assign(filled_shifts_threshold=filled.groupby('workplace_id', observed=True).cumcount() + 1)
+    filled = filled[filled['filled_shifts_threshold'].isin(thresholds)]
+    
+    # Is there posting activity at least 30 days after the n-th filled shift?
+    last_posts = latest_posts.reindex(filled['workplace_id']).to_numpy()
+    gaps = pd.to_timedelta(last_posts - filled['shift_start_at'].to_numpy())
+    retained = pd.Series(gaps.days >= 30, index=filled.index)
+    
+    retention_rates = retained.groupby(filled['filled_shifts_threshold']).mean()
+    return pd.DataFrame({
+        'filled_shifts_threshold': thresholds,
+        'retention_rate': retention_rates.reindex(thresholds, fill_value=0).to_numpy()
+    })
+
+
 def repeat_booking_analysis(df):
     """Analyze how frequently workers return to the same workplace."""
     print("Analyzing repeat booking patterns...")
@@ -476,11 +454,13 @@ def repeat_booking_analysis(df):
     # Filter to completed shifts for the main analysis
     completed_shifts = claimed_shifts[claimed_shifts['is_verified']].copy()
     
-    # Count shifts by worker-workplace pair
-    repeat_bookings = completed_shifts.groupby(['worker_id', 'workplace_id']).size().reset_index(name='shifts_completed')
+    # Completed shifts per worker x workplace pair, built once for the distribution, loyalty and churn metrics
+    bookings = interaction_matrix(df, df['claimed'] & df['is_verified'])
     
     # Distribution of repeat bookings
-    booking_distribution = repeat_bookings.groupby('shifts_completed').size().reset_index(name='count')
+    pair_counts = np.bincount(bookings.data)
+    shifts_completed = np.flatnonzero(pair_counts)
+    booking_distribution = pd.DataFrame({'shifts_completed': shifts_completed, 'count': pair_counts[shifts_completed]})
     booking_distribution['percentage'] = booking_distribution['count'] / booking_distribution['count'].sum() * 100
     
     # Truncate to reasonable values for the chart
@@ -517,14 +497,17 @@ def repeat_booking_analysis(df):
     
     # Analyze worker loyalty patterns
     # What percentage of a worker's shifts are at their most frequent workplace?
-    worker_loyalty = completed_shifts.groupby(['worker_id', 'workplace_id']).size().reset_index(name='shifts')
-    
-    # Get total shifts by worker
-    worker_totals = worker_loyalty.groupby('worker_id')['shifts'].sum().reset_index(name='total_shifts')
+    total_shifts = np.asarray(bookings.sum(axis=1)).ravel()
+    workers = np.flatnonzero(total_shifts)
     
     # Find each worker's most frequent workplace
-    worker_max = worker_loyalty.sort_values('shifts', ascending=False).drop_duplicates('worker_id')
-    worker_max = worker_max.merge(worker_totals, on='worker_id')
+    worker_bookings = bookings[workers]
+    worker_max = pd.DataFrame({
+        'worker_id': workers.astype(np.int32),
+        'workplace_id': np.asarray(worker_bookings.argmax(axis=1)).ravel().astype(np.int32),
+        'shifts': worker_bookings.max(axis=1).toarray().ravel(),
+        'total_shifts': total_shifts[workers]
+    }).sort_values('shifts', ascending=False, kind='stable').reset_index(drop=True)
     worker_max['loyalty_percent'] = worker_max['shifts'] / worker_max['total_shifts'] * 100
     
     # Calculate percentage of workers who do >50% of shifts at same workplace
@@ -545,18 +528,11 @@ def repeat_booking_analysis(df):
     plt.close()
     
     # Analyze the impact of workplace familiarity on no-show and cancellation rates
-    # First, create a dataset of all claims with their shift count at each workplace
-    completed_by_worker_workplace = df[df['claimed']].copy()
-    
-    # Add a "previous shifts at this workplace" counter
-    worker_workplace_pairs = completed_by_worker_workplace[['worker_id', 'workplace_id', 'shift_id', 'claimed_at', 'is_ncns', 'canceled', 'is_verified']]
-    worker_workplace_pairs = worker_workplace_pairs.sort_values(['worker_id', 'workplace_id', 'claimed_at'])
-    
-    # Group by worker and workplace
-    worker_workplace_pairs['previous_shifts'] = worker_workplace_pairs.groupby(['worker_id', 'workplace_id']).cumcount()
+    # Each claim's visit number at its workplace already counts the previous shifts there
+    previous_shifts = (claimed_shifts['worker_workplace_visit_num'] - 1).rename('previous_shifts')
     
     # Calculate cancellation and no-show rates by number of previous shifts
-    familiarity_metrics = worker_workplace_pairs.groupby('previous_shifts').agg({
+    familiarity_metrics = claimed_shifts.groupby(previous_shifts).agg({
         'shift_id': 'count',
         'is_ncns': 'sum',
         'canceled': 'sum',
@@ -607,20 +583,23 @@ def repeat_booking_analysis(df):
     churn_threshold = last_date - pd.Timedelta(days=30)
     
     # Get last view date for each worker
-    last_view_date = df.groupby('worker_id')['offer_viewed_at'].max()
+    last_view_date = df.groupby('worker_id', observed=True)['offer_viewed_at'].max()
     churned_workers = last_view_date[last_view_date < churn_threshold].index
     
     # Get the last completed shift for each worker before they churned
     last_shifts = completed_shifts[completed_shifts['worker_id'].isin(churned_workers)].copy()
     if len(last_shifts) > 0:
         last_shifts = last_shifts.sort_values(['worker_id', 'shift_start_at'])
-        last_shift_by_worker = last_shifts.groupby('worker_id').last().reset_index()
+        last_shift_by_worker = last_shifts.groupby('worker_id', observed=True).last().reset_index()
         
         # Count workers who churned after working at each workplace
-        workplace_churn = last_shift_by_worker.groupby('workplace_id').size().reset_index(name='churned_workers')
+        workplace_churn = last_shift_by_worker.groupby('workplace_id', observed=True).size().reset_index(name='churned_workers')
         
         # Count total workers who ever worked at each workplace
-        workplace_worker_counts = completed_shifts.groupby('workplace_id')['worker_id'].nunique().reset_index(name='total_workers')
+        workers_per_workplace = bookings.getnnz(axis=0)
+        workplaces = np.flatnonzero(workers_per_workplace)
+        workplace_worker_counts = pd.DataFrame({'workplace_id': workplaces.astype(np.int32),
+                                                'total_workers': workers_per_workplace[workplaces]})
         
         # Calculate churn rate by workplace
         workplace_churn = workplace_churn.merge(workplace_worker_counts, on='workplace_id', how='left')
@@ -644,12 +623,12 @@ def repeat_booking_analysis(df):
             print(f"Average workplace churn rate: {avg_churn_rate:.2%}")
             
             # Save workplace churn metrics
-            workplace_churn.to_csv(TABLE_DIR / 'workplace_churn_rates.csv', index=False)
+            decode_ids(workplace_churn, df).to_csv(TABLE_DIR / 'workplace_churn_rates.csv', index=False)
             
             # Plot top 10 highest churn workplaces
             top_n = min(10, len(workplace_churn))
             plt.figure(figsize=(12, 8))
-            sns.barplot(x='churn_rate', y='workplace_id', data=workplace_churn.head(top_n), color=COLORS['danger'])
+            sns.barplot(x='churn_rate', y='workplace_id', data=decode_ids(workplace_churn.head(top_n), df).astype({'workplace_id': str}), color=COLORS['danger'])
             
             plt.title('Workplaces with Highest Worker Churn Rates')
             plt.xlabel('Churn Rate')
@@ -701,9 +680,8 @@ def shift_deletion_analysis(df):
         return None, None
     
     # Calculate overall deletion rate
-    total_shifts = df['shift_id'].nunique()
-    deleted_shift_ids = deleted_shifts['shift_id'].unique()
-    deletion_rate = len(deleted_shift_ids) / total_shifts
+    facts = shift_facts(df)
+    deletion_rate = (facts['deleted'] > 0).sum() / len(facts)
     
     print(f"Overall shift deletion rate: {deletion_rate:.2%}")
     
@@ -777,16 +755,10 @@ def shift_deletion_analysis(df):
     
     # Analyze workplace-specific deletion patterns
     if 'workplace_id' in deleted_shifts.columns:
-        # Calculate deletion count by workplace
-        workplace_deletions = deleted_shifts.groupby('workplace_id')['shift_id'].nunique().reset_index()
-        workplace_deletions.columns = ['workplace_id', 'deleted_shifts']
-        
-        # Get total shifts posted by each workplace
-        total_by_workplace = df.groupby('workplace_id')['shift_id'].nunique().reset_index()
-        total_by_workplace.columns = ['workplace_id', 'total_shifts']
-        
-        # Merge data
-        workplace_deletions = workplace_deletions.merge(total_by_workplace, on='workplace_id')
+        # Deleted and total shifts by workplace, from the shared workplace feature table
+        features = workplace_features(df)
+        workplace_deletions = features.loc[features['deleted_shifts'] > 0, ['workplace_id', 'deleted_shifts', 'shifts_posted']]
+        workplace_deletions = workplace_deletions.rename(columns={'shifts_posted': 'total_shifts'}).reset_index(drop=True)
         
         # Calculate deletion rate
         workplace_deletions['deletion_rate'] = workplace_deletions['deleted_shifts'] / workplace_deletions['total_shifts']
@@ -808,7 +780,7 @@ def shift_deletion_analysis(df):
             # Plot top 10 highest deletion workplaces
             top_n = min(10, len(workplace_deletions))
             plt.figure(figsize=(12, 8))
-            sns.barplot(x='deletion_rate', y='workplace_id', data=workplace_deletions.head(top_n), color=COLORS['warning'])
+            sns.barplot(x='deletion_rate', y='workplace_id', data=decode_ids(workplace_deletions.head(top_n), df).astype({'workplace_id': str}), color=COLORS['warning'])
             
             plt.title('Workplaces with Highest Shift Deletion Rates')
             plt.xlabel('Deletion Rate')
@@ -820,38 +792,27 @@ def shift_deletion_analysis(df):
             plt.close()
             
             # Save workplace deletion metrics
-            workplace_deletions.to_csv(TABLE_DIR / 'workplace_deletion_patterns.csv', index=False)
+            decode_ids(workplace_deletions, df).to_csv(TABLE_DIR / 'workplace_deletion_patterns.csv', index=False)
             
             # Analyze worker engagement after experiencing a deletion
-            # Get all workers who experienced at least one deleted shift
-            workers_with_deletions = deleted_shifts['worker_id'].unique()
+            # Get all workers who experienced at least one deleted shift, with their first deletion
+            first_deletions = deleted_shifts.groupby('worker_id', observed=True, sort=False)['deleted_at'].min()
             
             # For each worker, calculate engagement before and after their first deletion experience
-            if len(workers_with_deletions) > 0:
-                worker_deletion_impact = []
+            if len(first_deletions) > 0:
+                impact = timeline_split(df, 'worker_id', 'offer_viewed_at', first_deletions, {'claims': df['claimed']})
                 
-                for worker_id in workers_with_deletions:
-                    worker_data = df[df['worker_id'] == worker_id].sort_values('offer_viewed_at')
-                    worker_deletions = deleted_shifts[deleted_shifts['worker_id'] == worker_id].sort_values('deleted_at')
-                    
-                    if len(worker_deletions) > 0:
-                        first_deletion = worker_deletions.iloc[0]['deleted_at']
-                        
-                        before_deletion = worker_data[worker_data['offer_viewed_at'] < first_deletion]
-                        after_deletion = worker_data[worker_data['offer_viewed_at'] >= first_deletion]
-                        
-                        # Need sufficient data before and after
-                        if len(before_deletion) >= 3 and len(after_deletion) >= 3:
-                            worker_deletion_impact.append({
-                                'worker_id': worker_id,
-                                'claim_rate_before': before_deletion['claimed'].mean(),
-                                'claim_rate_after': after_deletion['claimed'].mean(),
-                                'views_before': len(before_deletion),
-                                'views_after': len(after_deletion)
-                            })
+                # Need sufficient data before and after
+                impact = impact[(impact['views_before'] >= 3) & (impact['views_after'] >= 3)]
+                deletion_impact_df = pd.DataFrame({
+                    'worker_id': impact['worker_id'],
+                    'claim_rate_before': impact['claims_before'] / impact['views_before'],
+                    'claim_rate_after': impact['claims_after'] / impact['views_after'],
+                    'views_before': impact['views_before'],
+                    'views_after': impact['views_after']
+                }).reset_index(drop=True)
                 
-                if len(worker_deletion_impact) > 0:
-                    deletion_impact_df = pd.DataFrame(worker_deletion_impact)
+                if len(deletion_impact_df) > 0:
                     deletion_impact_df['claim_rate_change'] = deletion_impact_df['claim_rate_after'] - deletion_impact_df['claim_rate_before']
                     
                     # Calculate average impact
@@ -862,6 +823,6 @@ def shift_deletion_analysis(df):
                     print(f"Percentage of workers with decreased claim rate after deletion: {pct_decreased:.1f}%")
                     
                     # Save deletion impact data
-                    deletion_impact_df.to_csv(TABLE_DIR / 'deletion_impact_on_workers.csv', index=False)
+                    decode_ids(deletion_impact_df, df).to_csv(TABLE_DIR / 'deletion_impact_on_workers.csv', index=False)
     
     return deletion_times if 'deletion_times' in locals() else None, workplace_deletions if 'workplace_deletions' in locals() else None
\ No newline at end of file